@@ -1,21 +1,38 @@
 import os
+import asyncio
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+from decimal import Decimal
 import json
+import orjson
 from enum import Enum
-from typing import Literal, Dict, Any, List, Optional, Tuple
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Literal, Dict, Any, List, Optional, Tuple
 
-from fastapi import FastAPI, HTTPException, Request, Response, Depends
+from fastapi import FastAPI, HTTPException, Request, Response, Depends, BackgroundTasks
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.encoders import decimal_encoder
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 import stripe
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, Image
+from google.api_core.exceptions import GoogleAPICallError, ResourceExhausted
+
+if TYPE_CHECKING:
+    from vertexai.generative_models import GenerativeModel
 
 # Import per PostgreSQL diretto
 import psycopg2
 from psycopg2 import Error as Psycopg2Error
-from psycopg2.extras import DictCursor # Per ottenere risultati come dizionari
+from psycopg2.extras import DictCursor, Json # Per ottenere risultati come dizionari
+from psycopg2.pool import ThreadedConnectionPool
 
 # --- Initial Configuration ---
 load_dotenv()
@@ -24,15 +41,89 @@ STRIPE_SECRET_KEY = os.environ.get("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET")
 # DATABASE_URL sarà fornito da Railway/Neon
 DATABASE_URL = os.environ.get("DATABASE_URL")
+PG_POOL_MAX_CONN = int(os.environ.get("PG_POOL_MAX_CONN", "10"))
+# psycopg2 closes returned connections once minconn are already idle, so minconn is how many
+# connections the pool actually keeps open for reuse; it defaults to the full pool size.
+PG_POOL_MIN_CONN = min(int(os.environ.get("PG_POOL_MIN_CONN", str(PG_POOL_MAX_CONN))), PG_POOL_MAX_CONN)
+PG_POOL_TIMEOUT = float(os.environ.get("PG_POOL_TIMEOUT", "10"))
+# Connections idle in the pool for longer than this many seconds are checked with SELECT 1 before reuse.
+PG_POOL_PREPING_IDLE = float(os.environ.get("PG_POOL_PREPING_IDLE", "60"))
+PG_CONNECT_TIMEOUT = int(os.environ.get("PG_CONNECT_TIMEOUT", "10"))
+# Seconds of idleness before the kernel probes a pooled connection (0 = keep the OS default, usually 2 hours).
+PG_KEEPALIVES_IDLE = int(os.environ.get("PG_KEEPALIVES_IDLE", "30"))
+# Server-side cap per statement in ms (0 = off). Sent as a startup option, which some poolers
+# (e.g. PgBouncer without ignore_startup_parameters) reject, hence opt-in.
+PG_STATEMENT_TIMEOUT_MS = int(os.environ.get("PG_STATEMENT_TIMEOUT_MS", "0"))
 GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
 GCP_REGION = os.environ.get("GCP_REGION")
 GCP_SA_KEY_JSON_STR = os.environ.get("GCP_SA_KEY_JSON")
 STRIPE_PRICE_ID_PREMIUM = os.environ.get("STRIPE_PRICE_ID_PREMIUM")
 STRIPE_PRICE_ID_ASSISTANT = os.environ.get("STRIPE_PRICE_ID_ASSISTANT")
+STRIPE_HTTP_TIMEOUT = float(os.environ.get("STRIPE_HTTP_TIMEOUT", "10"))
+# Webhook events that failed or never finished are fetched from Stripe again once their latest claim is
+# STRIPE_EVENT_RETRY_AFTER seconds old; a sweep looks for them every STRIPE_EVENT_RETRY_INTERVAL seconds.
+STRIPE_EVENT_RETRY_INTERVAL = float(os.environ.get("STRIPE_EVENT_RETRY_INTERVAL", "300"))
+STRIPE_EVENT_RETRY_AFTER = float(os.environ.get("STRIPE_EVENT_RETRY_AFTER", "600"))
+STRIPE_EVENT_MAX_ATTEMPTS = int(os.environ.get("STRIPE_EVENT_MAX_ATTEMPTS", "10"))
 PAYPAL_CLIENT_ID = os.environ.get("PAYPAL_CLIENT_ID")
+AI_RESPONSE_CACHE_TTL = int(os.environ.get("AI_RESPONSE_CACHE_TTL", "3600"))
+AI_RESPONSE_CACHE_SIZE = int(os.environ.get("AI_RESPONSE_CACHE_SIZE", "1024"))
+LEADERBOARD_CACHE_TTL = int(os.environ.get("LEADERBOARD_CACHE_TTL", "60"))
+# How often a background task re-runs the leaderboard query; keep it below the TTL so the cache never goes cold.
+LEADERBOARD_REFRESH_INTERVAL = float(os.environ.get("LEADERBOARD_REFRESH_INTERVAL", str(LEADERBOARD_CACHE_TTL / 2)))
+SHOP_ITEMS_CACHE_TTL = int(os.environ.get("SHOP_ITEMS_CACHE_TTL", "300"))
+FEED_CACHE_TTL = int(os.environ.get("FEED_CACHE_TTL", "15"))
+CONTEST_CACHE_TTL = int(os.environ.get("CONTEST_CACHE_TTL", "60"))
+STRIPE_CUSTOMER_CACHE_TTL = int(os.environ.get("STRIPE_CUSTOMER_CACHE_TTL", "3600"))
+PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", "30"))
+# Per-process limits: with several workers the effective quota usage is workers x VERTEX_AI_RPM.
+VERTEX_AI_RPM = int(os.environ.get("VERTEX_AI_RPM", "60"))
+VERTEX_AI_MAX_CONCURRENCY = int(os.environ.get("VERTEX_AI_MAX_CONCURRENCY", "8"))
+VERTEX_AI_MAX_RETRIES = int(os.environ.get("VERTEX_AI_MAX_RETRIES", "4"))
+# Issues one tiny completion at startup so the first user request doesn't pay for lazy client setup.
+VERTEX_AI_PREWARM = os.environ.get("VERTEX_AI_PREWARM", "false").lower() in ("1", "true", "yes")
+# Threads behind asyncio.to_thread (blocking psycopg2 calls from async handlers).
+DEFAULT_EXECUTOR_WORKERS = int(os.environ.get("DEFAULT_EXECUTOR_WORKERS", "32"))
 
 # --- Service Initialization ---
-app = FastAPI(title="Zenith Rewards Backend", description="Backend per la gestione di utenti, AI, pagamenti e gamification per Zenith Rewards.")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The stock default executor is min(32, cpu_count + 4) threads, which on small containers
+    # is fewer than the DB pool and queues async handlers behind each other.
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DEFAULT_EXECUTOR_WORKERS, thread_name_prefix="blocking-io")
+    )
+    if DATABASE_URL:
+        try:
+            get_pg_pool()
+            logger.info("PostgreSQL connection pool initialized.")
+        except Psycopg2Error as e:
+            logger.critical(f"Failed to initialize PostgreSQL connection pool: {e}", exc_info=True)
+    else:
+        logger.warning("WARNING: DATABASE_URL not configured. Database functionalities are disabled.")
+    # vertexai.init resolves credentials and builds clients synchronously; keep it off the event loop.
+    await asyncio.to_thread(_init_vertex_ai)
+    if vertexai_initialized and VERTEX_AI_PREWARM:
+        try:
+            await _call_vertex(gemini_flash_model, "ping")
+            logger.info("Vertex AI client pre-warmed.")
+        except Exception as e:
+            logger.warning(f"Vertex AI pre-warm failed: {e}")
+    periodic_tasks = []
+    if DATABASE_URL:
+        periodic_tasks.append(asyncio.create_task(_refresh_leaderboard_periodically()))
+        if STRIPE_SECRET_KEY:
+            periodic_tasks.append(asyncio.create_task(_retry_stripe_events_periodically()))
+    yield
+    for task in periodic_tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    if _pg_pool is not None:
+        _pg_pool.closeall()
+        logger.info("PostgreSQL connection pool closed.")
+
+app = FastAPI(title="Zenith Rewards Backend", description="Backend per la gestione di utenti, AI, pagamenti e gamification per Zenith Rewards.", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 gemini_flash_model = None
 gemini_pro_vision_model = None
@@ -43,46 +134,104 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-if all([GCP_PROJECT_ID, GCP_REGION, GCP_SA_KEY_JSON_STR]):
+def _init_vertex_ai():
+    """Initializes Vertex AI from the in-memory service account key, without writing it to disk."""
+    global gemini_flash_model, gemini_pro_vision_model, vertexai_initialized
+    if not all([GCP_PROJECT_ID, GCP_REGION, GCP_SA_KEY_JSON_STR]):
+        logger.warning("WARNING: Missing GCP credentials. Vertex AI is disabled.")
+        return
     try:
-        sa_key_path = "/tmp/gcp_sa_key.json" # Use /tmp for Render ephemeral storage
-        with open(sa_key_path, "w") as f:
-            f.write(GCP_SA_KEY_JSON_STR)
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = sa_key_path
-
-        vertexai.init(project=GCP_PROJECT_ID, location=GCP_REGION)
+        # The Vertex AI SDK is slow to import; deployments without GCP never load it.
+        import vertexai
+        from vertexai.generative_models import GenerativeModel
+        from google.oauth2 import service_account
+
+        # Scoped explicitly so the first token request doesn't have to fall back to the SDK's defaults.
+        credentials = service_account.Credentials.from_service_account_info(
+            json.loads(GCP_SA_KEY_JSON_STR), scopes=["https://www.googleapis.com/auth/cloud-platform"]
+        )
+        vertexai.init(project=GCP_PROJECT_ID, location=GCP_REGION, credentials=credentials)
         gemini_flash_model = GenerativeModel("gemini-1.5-flash")
         gemini_pro_vision_model = GenerativeModel("gemini-pro-vision")
         vertexai_initialized = True
         logger.info("Vertex AI initialized successfully.")
     except Exception as e:
         logger.error(f"WARNING: Vertex AI configuration error: {e}. AI functionalities might be limited or unavailable.", exc_info=True)
-else:
-    logger.warning("WARNING: Missing GCP credentials. Vertex AI is disabled.")
 
 if STRIPE_SECRET_KEY:
     stripe.api_key = STRIPE_SECRET_KEY
+    # One pooled httpx client per process: keep-alive connections are reused across requests
+    # and the *_async methods don't block the event loop.
+    stripe.default_http_client = stripe.HTTPXClient(timeout=STRIPE_HTTP_TIMEOUT, allow_sync_methods=True)
     logger.info("Stripe API key loaded.")
 else:
     logger.warning("WARNING: STRIPE_SECRET_KEY not configured. Stripe functionalities are disabled.")
 
 FRONTEND_URL = os.environ.get("NEXT_PUBLIC_FRONTEND_URL", "https://cashhh-52f38.web.app")
 
-allowed_origins = [
+# FRONTEND_URL usually repeats one of the fixed origins, so the set drops the duplicate.
+allowed_origins = sorted({
     "http://localhost:3000",
     "https://cashhh-52f38.web.app",
     "https://cashhh-52738.web.app",
     FRONTEND_URL
-]
+})
+
+class UnhandledErrorMiddleware:
+    """
+    Turns unexpected exceptions into a generic JSON 500. An Exception handler on the app would run in
+    Starlette's ServerErrorMiddleware, outside CORSMiddleware, and the browser would only see a CORS error;
+    this middleware sits inside it, so the 500 carries the CORS headers like any HTTPException.
+    """
+    def __init__(self, app):
+        self.app = app
 
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        response_started = False
+
+        async def send_tracking_start(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_tracking_start)
+        except Exception as exc:
+            if response_started:
+                raise # Too late for a clean error response (e.g. a failing stream); let the server close it.
+            # Details stay in the logs; clients only get a generic message.
+            logger.critical(f"Unhandled exception on {scope['method']} {scope['path']}: {exc}", exc_info=exc)
+            await ORJSONResponse(status_code=500, content={"detail": "Internal server error."})(scope, receive, send)
+
+# Added first so it ends up inside CORSMiddleware (later add_middleware calls wrap earlier ones).
+app.add_middleware(UnhandledErrorMiddleware)
+# Explicit methods/headers (no wildcards) plus max_age let browsers cache preflights for a day.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
 )
 
+# --- Exception Handlers ---
+# Endpoints only raise HTTPException for expected failures; upstream errors are mapped here once, and
+# anything else becomes a 500 in UnhandledErrorMiddleware.
+@app.exception_handler(stripe.error.StripeError)
+async def stripe_error_handler(request: Request, exc: stripe.error.StripeError):
+    logger.error(f"Stripe error on {request.url.path}: {exc.user_message}", exc_info=exc)
+    return ORJSONResponse(status_code=502, content={"detail": f"Errore Stripe: {exc.user_message}"})
+
+@app.exception_handler(GoogleAPICallError)
+async def google_api_error_handler(request: Request, exc: GoogleAPICallError):
+    logger.error(f"Google API error on {request.url.path}: {exc}", exc_info=exc)
+    return ORJSONResponse(status_code=503, content={"detail": "AI service error. Please try again later."})
+
 POINTS_TO_EUR_RATE = 1000.0
 
 class SubscriptionPlan(str, Enum):
@@ -100,6 +249,41 @@ class ItemType(str, Enum):
     COSMETIC = 'COSMETIC'
     GENERATION_PACK = 'GENERATION_PACK'
 
+_PLANS_BY_VALUE: Dict[str, SubscriptionPlan] = {plan.value: plan for plan in SubscriptionPlan}
+
+def _plan_from_value(value: Optional[str]) -> SubscriptionPlan:
+    """Maps a stored subscription_plan string to its enum member, treating unknown values as FREE."""
+    return _PLANS_BY_VALUE.get(value, SubscriptionPlan.FREE)
+
+# Stripe price ids <-> paid plans. Unconfigured prices are left out so a missing env var can't match.
+PLAN_TO_PRICE: Dict[str, str] = {
+    plan: price_id for plan, price_id in (
+        (SubscriptionPlan.PREMIUM.value, STRIPE_PRICE_ID_PREMIUM),
+        (SubscriptionPlan.ASSISTANT.value, STRIPE_PRICE_ID_ASSISTANT),
+    ) if price_id
+}
+PRICE_TO_PLAN: Dict[str, str] = {price_id: plan for plan, price_id in PLAN_TO_PRICE.items()}
+
+ADVICE_PROMPT_TEMPLATES: Dict[SubscriptionPlan, str] = {
+    SubscriptionPlan.FREE: "Given the goal '{prompt}', provide 3 brief, impactful tips.",
+    SubscriptionPlan.PREMIUM: "Act as a business strategy expert. Given the goal '{prompt}', create a detailed 5-7 point action plan with practical examples and suggestions for marketing and social media.",
+    SubscriptionPlan.ASSISTANT: "You are a world-class business mentor and an expert in digital marketing, dropshipping, trading, and social media. Given the goal '{prompt}', create an extremely detailed and personalized step-by-step strategy, including specific tactics to scale both Zenith Rewards platform's social features and external social media, dropshipping, trading, and e-commerce tips, and a comprehensive virality plan. Your response must be complete, actionable, and cover all requested facets.",
+}
+
+CONTENT_PROMPT_TEMPLATES: Dict[ContentType, str] = {
+    ContentType.IMAGE: "Create a short text description and visual suggestion for an image based on: '{prompt}'.",
+    ContentType.POST: "Crea un post coinvolgente e conciso per i social media basato su: '{prompt}'. Focus su un linguaggio accattivante e hashtag pertinenti.",
+    ContentType.VIDEO: "Genera una breve sceneggiatura o un'idea per un video di 15-30 secondi basata su: '{prompt}'.",
+}
+
+# Virality plans are only generated for paid plans; FREE gets DEFAULT_STRATEGY_PLAN.
+STRATEGY_PROMPT_TEMPLATES: Dict[SubscriptionPlan, str] = {
+    SubscriptionPlan.PREMIUM: "Expand the virality plan for '{prompt}' and '{content_type}' with 3-5 digital marketing strategies and social engagement tips. Highlight keywords.",
+    SubscriptionPlan.ASSISTANT: "Act as an expert marketing consultant. Create a DETAILED ADVANCED VIRAL PLAN for the content '{prompt}' ({content_type}), including target analysis, distribution channels (Zenith Rewards and external social media), suggested publication calendar, collaboration ideas, SEO/hashtag optimization, and results measurement. Think like a growth hacker.",
+}
+
+DEFAULT_STRATEGY_PLAN = "Piano base per la viralità: Condividi la tua creazione sui social media di Zenith Rewards e incoraggia i tuoi amici a votare! Per strategie avanzate, considera l'upgrade al piano Premium o Assistant."
+
 class UserSyncRequest(BaseModel):
     user_id: str
     email: str | None = None
@@ -141,20 +325,91 @@ class ShopBuyRequest(BaseModel):
     user_id: str
     item_id: int
     payment_method: Literal['points', 'stripe']
+    idempotency_key: Optional[str] = None # Chiave del client per rendere sicuri i retry del pagamento (obbligatoria con Stripe)
 
 # --- Database Connection (PostgreSQL with psycopg2) ---
+_pg_pool: Optional[ThreadedConnectionPool] = None
+_pg_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises as soon as it is exhausted; the semaphore makes callers wait for a free connection instead.
+_pg_pool_slots = threading.BoundedSemaphore(PG_POOL_MAX_CONN)
+
+class _PooledConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that remembers since when it has been idle (monotonic time)."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The pool opens minconn connections up front, so idleness counts from creation too.
+        self.released_at: float = time.monotonic()
+
+def get_pg_pool() -> ThreadedConnectionPool:
+    """Returns the process-wide connection pool, creating it on first use."""
+    global _pg_pool
+    if _pg_pool is None:
+        with _pg_pool_lock:
+            if _pg_pool is None:
+                _pg_pool = ThreadedConnectionPool(
+                    PG_POOL_MIN_CONN, PG_POOL_MAX_CONN, DATABASE_URL, connection_factory=_PooledConnection, **_pg_connect_kwargs()
+                )
+    return _pg_pool
+
+def _pg_connect_kwargs() -> Dict[str, Any]:
+    """Connection settings layered on top of DATABASE_URL (keyword args override DSN values, so options are merged)."""
+    dsn = psycopg2.extensions.parse_dsn(DATABASE_URL)
+    kwargs: Dict[str, Any] = {"connect_timeout": PG_CONNECT_TIMEOUT}
+    # Pooled connections sit idle between bursts; keepalives stop NATs and load balancers from
+    # silently dropping them, and surface dead peers before a request checks one out.
+    if PG_KEEPALIVES_IDLE > 0 and "keepalives" not in dsn:
+        kwargs.update(keepalives=1, keepalives_idle=PG_KEEPALIVES_IDLE, keepalives_interval=10, keepalives_count=3)
+    if PG_STATEMENT_TIMEOUT_MS > 0:
+        dsn_options = dsn.get("options", "")
+        kwargs["options"] = f"{dsn_options} -c statement_timeout={PG_STATEMENT_TIMEOUT_MS}".strip()
+    return kwargs
+
 def get_pg_connection():
-    """Provides a psycopg2 connection to PostgreSQL."""
+    """Checks out a psycopg2 connection from the pool. Must be returned with release_pg_connection."""
+    if not _pg_pool_slots.acquire(timeout=PG_POOL_TIMEOUT):
+        logger.error("Timed out waiting for a free PostgreSQL connection.")
+        raise HTTPException(status_code=503, detail="Database is busy, please retry.")
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_pg_pool().getconn()
+        while not _pg_connection_usable(conn):
+            # The server or something in between dropped it while idle: swap it out. Every idle
+            # connection may be gone (e.g. after a server restart), so keep going until a live or
+            # newly opened one turns up.
+            get_pg_pool().putconn(conn, close=True)
+            conn = get_pg_pool().getconn()
         return conn
     except Psycopg2Error as e:
+        _pg_pool_slots.release()
         logger.critical(f"Failed to connect to PostgreSQL database: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Database connection failed: {e}")
     except Exception as e:
+        _pg_pool_slots.release()
         logger.critical(f"Unexpected error during DB connection: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
+def _pg_connection_usable(conn) -> bool:
+    """Pre-ping: connections that sat idle for more than PG_POOL_PREPING_IDLE seconds must answer SELECT 1."""
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.released_at < PG_POOL_PREPING_IDLE:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except Psycopg2Error as e:
+        logger.warning(f"Discarding stale pooled PostgreSQL connection: {e}")
+        return False
+
+def release_pg_connection(conn):
+    """Returns a connection to the pool, discarding it if the server side has gone away."""
+    try:
+        conn.released_at = time.monotonic()
+        get_pg_pool().putconn(conn, close=bool(conn.closed))
+    finally:
+        _pg_pool_slots.release()
+
 def _execute_pg_query(sql_query: str, params: Optional[Tuple] = None, fetch_one: bool = False, fetch_all: bool = False, error_context: str = "database operation"):
     """
     Executes a PostgreSQL query and handles transactions.
@@ -165,7 +420,7 @@ def _execute_pg_query(sql_query: str, params: Optional[Tuple] = None, fetch_one:
     try:
         conn = get_pg_connection()
         cursor = conn.cursor(cursor_factory=DictCursor) # Use DictCursor for dictionary results
-        logger.debug(f"Executing SQL: {sql_query} with params: {params}")
+        logger.debug("Executing SQL: %s with params: %s", sql_query, params)
 
         if params:
             cursor.execute(sql_query, params)
@@ -180,12 +435,15 @@ def _execute_pg_query(sql_query: str, params: Optional[Tuple] = None, fetch_one:
             return cursor.fetchall()
         return None # For INSERT/UPDATE/DELETE that don't need results
 
+    except HTTPException:
+        raise # e.g. the 503 from get_pg_connection when the pool is exhausted
     except Psycopg2Error as e:
-        if conn:
+        if conn and not conn.closed:
             conn.rollback() # Rollback on error
-        logger.error(f"PostgreSQL Error ({error_context}): Code={e.pgcode}, Message={e.pgerror.strip()}", exc_info=True)
+        pg_message = (e.pgerror or str(e)).strip() # pgerror is None for connection-level errors
+        logger.error(f"PostgreSQL Error ({error_context}): Code={e.pgcode}, Message={pg_message}", exc_info=True)
         # Rilancia un errore HTTP generico o più specifico se il codice errore lo permette
-        raise HTTPException(status_code=400, detail=f"Database error ({error_context}): {e.pgerror.strip()}")
+        raise HTTPException(status_code=400, detail=f"Database error ({error_context}): {pg_message}")
     except Exception as e:
         if conn:
             conn.rollback()
@@ -195,7 +453,143 @@ def _execute_pg_query(sql_query: str, params: Optional[Tuple] = None, fetch_one:
         if cursor:
             cursor.close()
         if conn:
-            conn.close()
+            release_pg_connection(conn)
+
+async def _execute_pg_query_async(*args, **kwargs):
+    """Runs _execute_pg_query in a worker thread so async endpoints don't block the event loop."""
+    return await asyncio.to_thread(_execute_pg_query, *args, **kwargs)
+
+# --- Read Caches ---
+# Per-process caches for public reads that tolerate a few seconds of staleness.
+# Sync endpoints run in the threadpool, so access goes through a lock.
+_leaderboard_cache: TTLCache = TTLCache(maxsize=1, ttl=LEADERBOARD_CACHE_TTL)
+_shop_items_cache: TTLCache = TTLCache(maxsize=1, ttl=SHOP_ITEMS_CACHE_TTL)
+_contest_cache: TTLCache = TTLCache(maxsize=len(SubscriptionPlan), ttl=CONTEST_CACHE_TTL)
+_feed_cache: TTLCache = TTLCache(maxsize=1, ttl=FEED_CACHE_TTL)
+# Serializes feed refills so a burst of misses runs the query once instead of once per request.
+_feed_refill_lock = asyncio.Lock()
+# user_id -> Stripe customer id. Only assigned ids are cached: they never change afterwards.
+_stripe_customer_cache: TTLCache = TTLCache(maxsize=10000, ttl=STRIPE_CUSTOMER_CACHE_TTL)
+# user_id -> {column tuple: record}. Dropped whenever this process writes the user's row;
+# writes from other workers show up once the entry expires.
+_profile_cache: TTLCache = TTLCache(maxsize=10000, ttl=PROFILE_CACHE_TTL)
+_read_cache_lock = threading.Lock()
+_CACHE_MISS = object()
+
+def _invalidate_feed_cache():
+    with _read_cache_lock:
+        _feed_cache.pop("feed", None)
+
+def _invalidate_user_cache(user_id: str):
+    with _read_cache_lock:
+        _profile_cache.pop(user_id, None)
+
+async def _cached_read(cache: TTLCache, key, loader):
+    """
+    Returns cache[key]. Hits are served on the event loop; on a miss the blocking loader()
+    runs in a worker thread and its result (None included) is stored.
+    """
+    with _read_cache_lock:
+        value = cache.get(key, _CACHE_MISS)
+    if value is _CACHE_MISS:
+        value = await asyncio.to_thread(loader)
+        with _read_cache_lock:
+            cache[key] = value
+    return value
+
+# --- AI Helpers ---
+class VertexRateLimiter:
+    """
+    Client-side throttle for Vertex AI: a concurrency cap plus a token bucket whose refill
+    rate follows AIMD (halved on quota errors, raised by one request/minute per success).
+    """
+    def __init__(self, rate_per_minute: int, max_concurrency: int):
+        self.max_rate = float(rate_per_minute)
+        self.rate = float(rate_per_minute)
+        self.capacity = float(max_concurrency)
+        self.tokens = float(max_concurrency)
+        self.updated_at = time.monotonic()
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate / 60.0)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) * 60.0 / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + 1)
+
+    def on_throttled(self):
+        self.rate = max(1.0, self.rate / 2)
+        logger.warning(f"Vertex AI quota exhausted, lowering client rate to {self.rate:.1f} requests/minute.")
+
+_vertex_limiter = VertexRateLimiter(VERTEX_AI_RPM, VERTEX_AI_MAX_CONCURRENCY)
+
+@retry(
+    retry=retry_if_exception_type(ResourceExhausted),
+    wait=wait_exponential_jitter(initial=1, max=20),
+    stop=stop_after_attempt(VERTEX_AI_MAX_RETRIES),
+    reraise=True,
+)
+async def _call_vertex(model: "GenerativeModel", prompt: str):
+    """Calls model.generate_content_async through the rate limiter, retrying 429s with jittered backoff."""
+    async with _vertex_limiter.semaphore:
+        await _vertex_limiter.acquire()
+        try:
+            response_ai = await model.generate_content_async(prompt)
+        except ResourceExhausted:
+            _vertex_limiter.on_throttled()
+            raise
+    _vertex_limiter.on_success()
+    return response_ai
+
+# Completions keyed by normalized prompt. Prompts already embed the plan and content type,
+# so equivalent requests share an answer without another Vertex AI round trip.
+_ai_response_cache: TTLCache = TTLCache(maxsize=AI_RESPONSE_CACHE_SIZE, ttl=AI_RESPONSE_CACHE_TTL)
+
+def _normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.split()).casefold()
+
+async def _generate_text(model: "GenerativeModel", prompt: str) -> str:
+    """Returns the stripped completion for prompt, served from the response cache when possible."""
+    cache_key = _normalize_prompt(prompt)
+    cached_text = _ai_response_cache.get(cache_key)
+    if cached_text is not None:
+        logger.info("AI response cache hit.")
+        return cached_text
+    response_ai = await _call_vertex(model, prompt)
+    generated_text = response_ai.text.strip()
+    _ai_response_cache[cache_key] = generated_text
+    return generated_text
+
+async def _stream_text(model: "GenerativeModel", prompt: str):
+    """Yields the completion for prompt chunk by chunk as Vertex AI produces it, filling the response cache at the end."""
+    cache_key = _normalize_prompt(prompt)
+    cached_text = _ai_response_cache.get(cache_key)
+    if cached_text is not None:
+        logger.info("AI response cache hit.")
+        yield cached_text
+        return
+    # A stream can't be replayed once chunks are sent, so 429s are not retried here.
+    chunks = []
+    async with _vertex_limiter.semaphore:
+        await _vertex_limiter.acquire()
+        try:
+            async for chunk in await model.generate_content_async(prompt, stream=True):
+                chunks.append(chunk.text)
+                yield chunk.text
+        except ResourceExhausted:
+            _vertex_limiter.on_throttled()
+            raise
+    _vertex_limiter.on_success()
+    _ai_response_cache[cache_key] = "".join(chunks).strip()
 
 # --- Managers (Adapted for psycopg2) ---
 
@@ -205,64 +599,34 @@ class UserManager:
     def sync_user(self, user_data: UserSyncRequest):
         now = datetime.now(timezone.utc)
         logger.info(f"Attempting to sync user: {user_data.user_id}")
-        
-        user_record = _execute_pg_query(
-            "SELECT user_id, last_login_at, login_streak, daily_ai_generations_used, last_generation_reset_date, daily_votes_used, last_vote_reset_date FROM users WHERE user_id = %s",
-            (user_data.user_id,), fetch_one=True, error_context="user sync fetch"
+
+        # One upsert instead of SELECT + INSERT/UPDATE: Postgres computes the streak and the daily
+        # counter resets from the stored row, so concurrent logins can't race between read and write.
+        # Days are UTC days, as in the advice quota and cast_vote, whatever the DB session time zone is.
+        result = _execute_pg_query(
+            """
+            INSERT INTO users (user_id, email, display_name, referrer_id, avatar_url, login_streak, last_login_at, points_balance, pending_points_balance, subscription_plan, daily_ai_generations_used, last_generation_reset_date, daily_votes_used, last_vote_reset_date, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET
+                last_login_at = EXCLUDED.last_login_at,
+                login_streak = CASE (EXCLUDED.last_login_at AT TIME ZONE 'UTC')::date - (COALESCE(users.last_login_at, EXCLUDED.last_login_at) AT TIME ZONE 'UTC')::date
+                    WHEN 0 THEN COALESCE(users.login_streak, 0)
+                    WHEN 1 THEN COALESCE(users.login_streak, 0) + 1
+                    ELSE 1
+                END,
+                daily_ai_generations_used = CASE WHEN (users.last_generation_reset_date AT TIME ZONE 'UTC')::date < (EXCLUDED.last_login_at AT TIME ZONE 'UTC')::date THEN 0 ELSE users.daily_ai_generations_used END,
+                last_generation_reset_date = CASE WHEN (users.last_generation_reset_date AT TIME ZONE 'UTC')::date < (EXCLUDED.last_login_at AT TIME ZONE 'UTC')::date THEN EXCLUDED.last_login_at ELSE users.last_generation_reset_date END,
+                daily_votes_used = CASE WHEN (users.last_vote_reset_date AT TIME ZONE 'UTC')::date < (EXCLUDED.last_login_at AT TIME ZONE 'UTC')::date THEN 0 ELSE users.daily_votes_used END,
+                last_vote_reset_date = CASE WHEN (users.last_vote_reset_date AT TIME ZONE 'UTC')::date < (EXCLUDED.last_login_at AT TIME ZONE 'UTC')::date THEN EXCLUDED.last_login_at ELSE users.last_vote_reset_date END
+            RETURNING (xmax = 0) AS inserted
+            """,
+            (user_data.user_id, user_data.email, user_data.displayName, user_data.referrer_id, user_data.avatar_url, 1, now, 0, 0, SubscriptionPlan.FREE.value, 0, now, 0, now, now),
+            fetch_one=True, error_context="upsert user"
         )
-        
-        if not user_record:
-            logger.info(f"Creating new user: {user_data.user_id}")
-            _execute_pg_query(
-                """
-                INSERT INTO users (user_id, email, display_name, referrer_id, avatar_url, login_streak, last_login_at, points_balance, pending_points_balance, subscription_plan, daily_ai_generations_used, last_generation_reset_date, daily_votes_used, last_vote_reset_date, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (user_data.user_id, user_data.email, user_data.displayName, user_data.referrer_id, user_data.avatar_url, 1, now, 0, 0, SubscriptionPlan.FREE.value, 0, now, 0, now, now),
-                error_context="insert new user"
-            )
+        _invalidate_user_cache(user_data.user_id)
+        if result and result['inserted']:
             logger.info(f"New user {user_data.user_id} created successfully.")
         else:
-            logger.info(f"Updating existing user: {user_data.user_id}")
-            # Ensure datetime objects are passed, psycopg2 handles conversion
-            last_login_dt = user_record['last_login_at'] if user_record['last_login_at'] else now
-            current_streak = user_record['login_streak'] if user_record['login_streak'] is not None else 0
-            
-            new_streak = 1
-            if last_login_dt:
-                last_login_date_only = last_login_dt.date()
-                today = now.date()
-                days_diff = (today - last_login_date_only).days
-
-                if days_diff == 1:
-                    new_streak = current_streak + 1
-                elif days_diff == 0:
-                    new_streak = current_streak
-            
-            update_data_params = [now, new_streak] # Order matters for SQL query
-            
-            daily_ai_generations_used_val = user_record['daily_ai_generations_used']
-            last_generation_reset_date_val = user_record['last_generation_reset_date']
-
-            if now.date() > (last_generation_reset_date_val.date() if last_generation_reset_date_val else now.date()):
-                daily_ai_generations_used_val = 0
-                last_generation_reset_date_val = now
-            
-            update_data_params.extend([daily_ai_generations_used_val, last_generation_reset_date_val])
-
-            daily_votes_used_val = user_record['daily_votes_used']
-            last_vote_reset_date_val = user_record['last_vote_reset_date']
-            if now.date() > (last_vote_reset_date_val.date() if last_vote_reset_date_val else now.date()):
-                daily_votes_used_val = 0
-                last_vote_reset_date_val = now
-
-            update_data_params.extend([daily_votes_used_val, last_vote_reset_date_val])
-            update_data_params.append(user_data.user_id) # Final parameter for WHERE clause
-
-            _execute_pg_query(
-                "UPDATE users SET last_login_at = %s, login_streak = %s, daily_ai_generations_used = %s, last_generation_reset_date = %s, daily_votes_used = %s, last_vote_reset_date = %s WHERE user_id = %s",
-                tuple(update_data_params), error_context="update existing user"
-            )
             logger.info(f"User {user_data.user_id} updated successfully.")
         return {"status": "success"}
 
@@ -285,6 +649,7 @@ class UserManager:
         update_values.append(user_id)
 
         _execute_pg_query(sql_query, tuple(update_values), error_context="update user profile")
+        _invalidate_user_cache(user_id)
         logger.info(f"Profile for user {user_id} updated successfully.")
         return {"status": "success", "message": "Profile updated successfully."}
 
@@ -299,31 +664,108 @@ class UserManager:
             raise HTTPException(status_code=404, detail="User not found.")
         return user_record
 
+    PROFILE_COLUMNS = ("subscription_plan", "daily_ai_generations_used", "last_generation_reset_date", "daily_votes_used", "last_vote_reset_date", "points_balance", "stripe_customer_id")
+
     def get_user_profile(self, user_id: str):
         logger.info(f"Fetching profile for user: {user_id}")
+        return self.get_cached_user_fields(user_id, *self.PROFILE_COLUMNS)
+
+    def get_cached_user_fields(self, user_id: str, *columns: str) -> Dict[str, Any]:
+        """
+        get_user_fields through the per-process profile cache. Only for reads that can live
+        with PROFILE_CACHE_TTL of staleness; quota and balance checks read the row directly.
+        """
+        with _read_cache_lock:
+            user_record = _profile_cache.get(user_id, {}).get(columns)
+        if user_record is None:
+            user_record = self.get_user_fields(user_id, *columns)
+            with _read_cache_lock:
+                _profile_cache.setdefault(user_id, {})[columns] = user_record
+        return dict(user_record)
+
+    def get_user_fields(self, user_id: str, *columns: str) -> Dict[str, Any]:
+        """
+        Reads only the given profile columns (names from PROFILE_COLUMNS, never user input).
+        Missing users get default values, as the profile always has.
+        """
         user_record = _execute_pg_query(
-            "SELECT subscription_plan, daily_ai_generations_used, last_generation_reset_date, daily_votes_used, last_vote_reset_date, points_balance, stripe_customer_id FROM users WHERE user_id = %s",
+            f"SELECT {', '.join(columns)} FROM users WHERE user_id = %s",
             (user_id,), fetch_one=True, error_context="fetch user profile"
         )
         if not user_record:
             logger.warning(f"User {user_id} not found when fetching profile. Returning default data.")
-            return {
+            now = datetime.now(timezone.utc)
+            defaults = {
                 "subscription_plan": SubscriptionPlan.FREE.value,
                 "daily_ai_generations_used": 0,
-                "last_generation_reset_date": datetime.now(timezone.utc).isoformat(),
+                "last_generation_reset_date": now,
                 "daily_votes_used": 0,
-                "last_vote_reset_date": datetime.now(timezone.utc).isoformat(),
+                "last_vote_reset_date": now,
                 "points_balance": 0,
                 "stripe_customer_id": None # Add stripe_customer_id to default
             }
-        # Convert datetime objects to ISO format strings for consistency
-        user_record['last_generation_reset_date'] = user_record['last_generation_reset_date'].isoformat() if user_record['last_generation_reset_date'] else None
-        user_record['last_vote_reset_date'] = user_record['last_vote_reset_date'].isoformat() if user_record['last_vote_reset_date'] else None
+            return {column: defaults[column] for column in columns}
+        # Reset dates stay datetime objects so callers can compare them without re-parsing;
+        # the response encoder renders them as ISO strings.
+        user_record = dict(user_record)
         # Ensure subscription_plan and other nullable fields are handled
-        user_record['subscription_plan'] = user_record['subscription_plan'] if user_record['subscription_plan'] else SubscriptionPlan.FREE.value
-        user_record['stripe_customer_id'] = user_record['stripe_customer_id']
+        if 'subscription_plan' in user_record and not user_record['subscription_plan']:
+            user_record['subscription_plan'] = SubscriptionPlan.FREE.value
         return user_record
 
+    def get_subscription_plan(self, user_id: str) -> SubscriptionPlan:
+        return _plan_from_value(self.get_cached_user_fields(user_id, "subscription_plan")['subscription_plan'])
+
+    def get_stripe_customer(self, user_id: str):
+        """
+        Returns the user's email and Stripe customer id. When the customer id is
+        already cached the database isn't queried and email is None (it's only
+        needed to create a new customer).
+        """
+        with _read_cache_lock:
+            cached_customer_id = _stripe_customer_cache.get(user_id)
+        if cached_customer_id:
+            return {"email": None, "stripe_customer_id": cached_customer_id}
+
+        user_record = _execute_pg_query(
+            "SELECT email, stripe_customer_id FROM users WHERE user_id = %s",
+            (user_id,), fetch_one=True, error_context="fetch Stripe customer"
+        )
+        if not user_record:
+            return {"email": None, "stripe_customer_id": None}
+        if user_record['stripe_customer_id']:
+            self._remember_stripe_customer(user_id, user_record['stripe_customer_id'])
+        return {"email": user_record['email'], "stripe_customer_id": user_record['stripe_customer_id']}
+
+    def set_stripe_customer(self, user_id: str, customer_id: str) -> str:
+        """
+        Stores customer_id unless the user already has one, and returns the id that
+        ends up on the row, so concurrent checkouts converge on a single customer.
+        """
+        user_record = _execute_pg_query(
+            """
+            WITH assigned AS (
+                UPDATE users SET stripe_customer_id = %s
+                WHERE user_id = %s AND stripe_customer_id IS NULL
+                RETURNING stripe_customer_id
+            )
+            SELECT stripe_customer_id FROM assigned
+            UNION ALL
+            SELECT stripe_customer_id FROM users WHERE user_id = %s AND NOT EXISTS (SELECT 1 FROM assigned)
+            """,
+            (customer_id, user_id, user_id), fetch_one=True, error_context="update user with Stripe customer ID"
+        )
+        if user_record and user_record['stripe_customer_id']:
+            customer_id = user_record['stripe_customer_id']
+            self._remember_stripe_customer(user_id, customer_id)
+        _invalidate_user_cache(user_id)
+        return customer_id
+
+    @staticmethod
+    def _remember_stripe_customer(user_id: str, customer_id: str):
+        with _read_cache_lock:
+            _stripe_customer_cache[user_id] = customer_id
+
     def get_streak_status(self, user_id: str):
         logger.info(f"Fetching streak status for user: {user_id}")
         user_record = _execute_pg_query(
@@ -344,6 +786,7 @@ class UserManager:
             "SELECT claim_streak_reward(%s) AS result",
             (user_id,), fetch_one=True, error_context="claim streak RPC"
         )
+        _invalidate_user_cache(user_id)
         if result_data and result_data['result']: # The function returns jsonb
             return result_data['result']
         logger.error(f"Unexpected RPC return for claim_streak_reward for user {user_id}: {result_data}")
@@ -351,90 +794,157 @@ class UserManager:
 
     def get_referral_stats(self, user_id: str):
         logger.info(f"Fetching referral stats for user: {user_id}")
+        # Counter maintained by a trigger on users inserts (see migrations/008_users_referral_count.sql).
         referral_count_res = _execute_pg_query(
-            "SELECT COUNT(*) FROM users WHERE referrer_id = %s",
+            "SELECT referral_count FROM users WHERE user_id = %s",
             (user_id,), fetch_one=True, error_context="fetch referral count"
         )
-        referral_count = referral_count_res['count'] if referral_count_res and 'count' in referral_count_res else 0
+        referral_count = referral_count_res['referral_count'] if referral_count_res else 0
 
         referral_earnings = referral_count * 100
         logger.info(f"Referral stats for {user_id}: count={referral_count}, earnings={referral_earnings}")
         return {"referral_count": referral_count, "referral_earnings": referral_earnings}
 
 class AIManager:
-    def __init__(self): pass
+    def __init__(self, user_manager: UserManager):
+        self.user_manager = user_manager
 
-    AI_GENERATION_LIMITS = {
+    # Read-only: these tables are shared by every request.
+    AI_GENERATION_LIMITS = MappingProxyType({
         SubscriptionPlan.FREE: 3,
         SubscriptionPlan.PREMIUM: 15,
         SubscriptionPlan.ASSISTANT: 100
-    }
-    DAILY_VOTE_LIMITS = {
+    })
+    DAILY_VOTE_LIMITS = MappingProxyType({
         SubscriptionPlan.FREE: 5,
         SubscriptionPlan.PREMIUM: 20,
         SubscriptionPlan.ASSISTANT: 50
-    }
+    })
+    # cast_vote and the advice reservation look limits up by the stored plan string.
+    DAILY_VOTE_LIMITS_BY_VALUE = MappingProxyType({plan.value: limit for plan, limit in DAILY_VOTE_LIMITS.items()})
+    AI_GENERATION_LIMITS_BY_VALUE = MappingProxyType({plan.value: limit for plan, limit in AI_GENERATION_LIMITS.items()})
+    AI_COSTS = MappingProxyType({
+        SubscriptionPlan.FREE: MappingProxyType({"points": 500, "eur": 0.50}),
+        SubscriptionPlan.PREMIUM: MappingProxyType({"points": 200, "eur": 0.20}),
+        SubscriptionPlan.ASSISTANT: MappingProxyType({"points": 100, "eur": 0.10}),
+    })
+    DEFAULT_AI_COST = MappingProxyType({"points": 1000, "eur": 1.00})
 
     def get_ai_cost(self, user_plan: SubscriptionPlan):
-        if user_plan == SubscriptionPlan.FREE:
-            return {"points": 500, "eur": 0.50}
-        elif user_plan == SubscriptionPlan.PREMIUM:
-            return {"points": 200, "eur": 0.20}
-        elif user_plan == SubscriptionPlan.ASSISTANT:
-            return {"points": 100, "eur": 0.10}
-        return {"points": 1000, "eur": 1.00}
+        return self.AI_COSTS.get(user_plan, self.DEFAULT_AI_COST)
 
-    async def generate_advice(self, req: AIAdviceRequest):
+    # Days are UTC days, whatever the DB session time zone is.
+    _ADVICE_RESET_DUE = "(last_generation_reset_date IS NULL OR (last_generation_reset_date AT TIME ZONE 'UTC')::date < (now() AT TIME ZONE 'UTC')::date)"
+
+    async def _prepare_advice(self, req: AIAdviceRequest):
+        """Reserves one of today's advice generations and returns (final_prompt, reserved)."""
         if not vertexai_initialized or not gemini_flash_model:
             logger.error("AI service (Gemini Flash) is not available.")
             raise HTTPException(status_code=503, detail="AI service (Gemini Flash) is not available or not initialized.")
 
-        user_manager = UserManager() # Create manager instance for profile access
-        user_profile = user_manager.get_user_profile(req.user_id)
-        user_plan = SubscriptionPlan(user_profile.get('subscription_plan', SubscriptionPlan.FREE.value))
-        generations_used = user_profile.get('daily_ai_generations_used', 0)
-        last_reset_dt = datetime.fromisoformat(user_profile.get('last_generation_reset_date', datetime.now(timezone.utc).isoformat()))
-        
-        if datetime.now(timezone.utc).date() > last_reset_dt.date():
-            generations_used = 0
-            _execute_pg_query(
-                "UPDATE users SET daily_ai_generations_used = %s, last_generation_reset_date = %s WHERE user_id = %s",
-                (0, datetime.now(timezone.utc), req.user_id), error_context="reset daily AI generations"
+        # Check and increment in one conditional UPDATE, so concurrent requests can't all pass the
+        # limit; a pending daily reset is applied by the same statement.
+        limits = Json(dict(self.AI_GENERATION_LIMITS_BY_VALUE))
+        reservation = await _execute_pg_query_async(
+            f"""
+            UPDATE users SET
+                daily_ai_generations_used = CASE WHEN {self._ADVICE_RESET_DUE} THEN 1 ELSE COALESCE(daily_ai_generations_used, 0) + 1 END,
+                last_generation_reset_date = CASE WHEN {self._ADVICE_RESET_DUE} THEN now() ELSE last_generation_reset_date END
+            WHERE user_id = %s
+              AND CASE WHEN {self._ADVICE_RESET_DUE} THEN 0 ELSE COALESCE(daily_ai_generations_used, 0) END
+                  < COALESCE((%s::jsonb ->> subscription_plan)::integer, (%s::jsonb ->> 'free')::integer)
+            RETURNING subscription_plan
+            """,
+            (req.user_id, limits, limits), fetch_one=True, error_context="reserve daily AI generation"
+        )
+        reserved = reservation is not None
+        if reserved:
+            _invalidate_user_cache(req.user_id)
+            user_plan = _plan_from_value(reservation['subscription_plan'])
+        else:
+            # Either the limit is reached or there is no such user; the latter keeps the old behaviour
+            # of generating on the free plan without counting usage.
+            user_row = await _execute_pg_query_async(
+                "SELECT subscription_plan FROM users WHERE user_id = %s",
+                (req.user_id,), fetch_one=True, error_context="fetch user plan"
             )
+            user_plan = _plan_from_value(user_row['subscription_plan'] if user_row else None)
+            if user_row:
+                logger.warning(f"User {req.user_id} exceeded AI generation limit for plan {user_plan.value}")
+                raise HTTPException(status_code=429, detail=f"Hai raggiunto il limite di generazioni AI giornaliere ({self.AI_GENERATION_LIMITS.get(user_plan, 0)}) per il tuo piano '{user_plan.value}'. Effettua l'upgrade per più generazioni!")
+            logger.warning(f"User {req.user_id} not found when reserving an AI generation. Using the free plan.")
 
-        if generations_used >= self.AI_GENERATION_LIMITS.get(user_plan, 0):
-            logger.warning(f"User {req.user_id} exceeded AI generation limit for plan {user_plan.value}")
-            raise HTTPException(status_code=429, detail=f"Hai raggiunto il limite di generazioni AI giornaliere ({self.AI_GENERATION_LIMITS.get(user_plan, 0)}) per il tuo piano '{user_plan.value}'. Effettua l'upgrade per più generazioni!")
+        final_prompt = ADVICE_PROMPT_TEMPLATES[user_plan].format_map({"prompt": req.prompt})
+        return final_prompt, reserved
 
-        final_prompt = f"Given the goal '{req.prompt}', provide 3 brief, impactful tips."
-        if user_plan == SubscriptionPlan.PREMIUM:
-            final_prompt = f"Act as a business strategy expert. Given the goal '{req.prompt}', create a detailed 5-7 point action plan with practical examples and suggestions for marketing and social media."
-        elif user_plan == SubscriptionPlan.ASSISTANT:
-            final_prompt = f"You are a world-class business mentor and an expert in digital marketing, dropshipping, trading, and social media. Given the goal '{req.prompt}', create an extremely detailed and personalized step-by-step strategy, including specific tactics to scale both Zenith Rewards platform's social features and external social media, dropshipping, trading, and e-commerce tips, and a comprehensive virality plan. Your response must be complete, actionable, and cover all requested facets."
-        
+    async def _release_advice_generation(self, user_id: str):
+        """Gives back a reserved generation whose completion failed or was abandoned."""
         try:
-            logger.info(f"Generating AI advice for user {req.user_id} with prompt: {req.prompt[:50]}...")
-            response_ai = gemini_flash_model.generate_content(final_prompt)
-            generated_text = response_ai.text.strip()
-
-            _execute_pg_query(
-                "UPDATE users SET daily_ai_generations_used = %s WHERE user_id = %s",
-                (generations_used + 1, req.user_id), error_context="increment daily AI generations"
+            # After a day rollover the counter was reset, so the reserved slot is already gone.
+            await _execute_pg_query_async(
+                f"UPDATE users SET daily_ai_generations_used = daily_ai_generations_used - 1 WHERE user_id = %s AND NOT {self._ADVICE_RESET_DUE}",
+                (user_id,), error_context="release daily AI generation"
             )
-            logger.info(f"AI advice generated and usage incremented for user {req.user_id}.")
-            return {"advice": generated_text}
-        except Exception as e:
-            logger.error(f"Error during AI advice generation for user {req.user_id}: {e}", exc_info=True)
-            raise HTTPException(status_code=503, detail=f"AI service error: {e}. Please try again later.")
+            _invalidate_user_cache(user_id)
+        except HTTPException:
+            logger.error(f"Could not release the reserved AI generation for user {user_id}.")
+
+    async def generate_advice(self, req: AIAdviceRequest):
+        final_prompt, reserved = await self._prepare_advice(req)
+
+        logger.info(f"Generating AI advice for user {req.user_id} with prompt: {req.prompt[:50]}...")
+        try:
+            generated_text = await _generate_text(gemini_flash_model, final_prompt)
+        except BaseException:
+            # Usage is only counted for completions that were delivered.
+            if reserved:
+                await self._release_advice_generation(req.user_id)
+            raise
+        logger.info(f"AI advice generated for user {req.user_id}.")
+        return {"advice": generated_text}
+
+    async def stream_advice(self, req: AIAdviceRequest):
+        """
+        Same as generate_advice, but returns an async iterator of server-sent events: one
+        `data: {"t": ...}` event per chunk, then `event: done`. Quota errors are raised before
+        the first byte; a failure mid-stream is reported as `event: error`.
+        """
+        final_prompt, reserved = await self._prepare_advice(req)
+
+        async def events():
+            logger.info(f"Streaming AI advice for user {req.user_id} with prompt: {req.prompt[:50]}...")
+            completed = False
+            try:
+                # The 200 and its headers are already out, so every failure from here on has to end the
+                # stream with an error event; nothing may escape and cut it off without done or error.
+                try:
+                    async for text in _stream_text(gemini_flash_model, final_prompt):
+                        yield b"data: " + orjson.dumps({"t": text}) + b"\n\n"
+                except GoogleAPICallError as e:
+                    logger.error(f"Error during AI advice streaming for user {req.user_id}: {e}", exc_info=True)
+                    yield b"event: error\ndata: " + orjson.dumps({"detail": "AI service error. Please try again later."}) + b"\n\n"
+                    return
+                except Exception as e:
+                    # e.g. a safety-blocked chunk without text.
+                    logger.critical(f"Unexpected error during AI advice streaming for user {req.user_id}: {e}", exc_info=True)
+                    yield b"event: error\ndata: " + orjson.dumps({"detail": "Internal server error."}) + b"\n\n"
+                    return
+                completed = True
+                yield b"event: done\ndata: {}\n\n"
+            finally:
+                # Usage is only counted for completions that reached the end (errors and client disconnects give the slot back).
+                if reserved and not completed:
+                    await self._release_advice_generation(req.user_id)
+
+        return events()
 
     async def generate_content(self, req: AIGenerationRequest):
         if not vertexai_initialized:
             logger.error("AI service is not available for content generation.")
             raise HTTPException(status_code=503, detail="AI service is not available.")
 
-        user_manager = UserManager()
-        user_profile = user_manager.get_user_profile(req.user_id)
-        user_plan = SubscriptionPlan(user_profile.get('subscription_plan', SubscriptionPlan.FREE.value))
+        user_profile = await asyncio.to_thread(self.user_manager.get_user_fields, req.user_id, "subscription_plan", "points_balance")
+        user_plan = _plan_from_value(user_profile.get('subscription_plan'))
         
         cost = self.get_ai_cost(user_plan)
         
@@ -447,73 +957,63 @@ class AIManager:
 
         generated_url = None
         generated_text = None
-        ai_strategy_plan = f"Piano base per la viralità: Condividi la tua creazione sui social media di Zenith Rewards e incoraggia i tuoi amici a votare! Per strategie avanzate, considera l'upgrade al piano Premium o Assistant."
-
-        try:
-            logger.info(f"Generating AI content ({req.content_type.value}) for user {req.user_id} with prompt: {req.prompt[:50]}...")
-            if req.content_type == ContentType.IMAGE:
-                if not gemini_pro_vision_model:
-                     raise HTTPException(status_code=503, detail="AI image generation model not available.")
-                image_response = gemini_pro_vision_model.generate_content(f"Create a short text description and visual suggestion for an image based on: '{req.prompt}'.")
-                generated_text = f"Immagine generata: {image_response.text.strip()}\n(Simulazione: L'API reale genererebbe un URL immagine.)"
-                generated_url = "https://via.placeholder.com/400x300?text=AI+Image"
-
-            elif req.content_type == ContentType.POST:
-                response_ai = gemini_flash_model.generate_content(f"Crea un post coinvolgente e conciso per i social media basato su: '{req.prompt}'. Focus su un linguaggio accattivante e hashtag pertinenti.")
-                generated_text = response_ai.text.strip()
-            
-            elif req.content_type == ContentType.VIDEO:
-                response_ai = gemini_flash_model.generate_content(f"Genera una breve sceneggiatura o un'idea per un video di 15-30 secondi basata su: '{req.prompt}'.")
-                generated_text = f"Sceneggiatura video generata: {response_ai.text.strip()}\n(Simulazione: L'API reale genererebbe un URL video.)"
-                generated_url = "https://www.w3schools.com/html/mov_bbb.mp4"
-
-            if user_plan == SubscriptionPlan.PREMIUM:
-                strategy_response = gemini_flash_model.generate_content(f"Expand the virality plan for '{req.prompt}' and '{req.content_type.value}' with 3-5 digital marketing strategies and social engagement tips. Highlight keywords.")
-                ai_strategy_plan = strategy_response.text.strip()
-            elif user_plan == SubscriptionPlan.ASSISTANT:
-                strategy_response = gemini_flash_model.generate_content(f"Act as an expert marketing consultant. Create a DETAILED ADVANCED VIRAL PLAN for the content '{req.prompt}' ({req.content_type.value}), including target analysis, distribution channels (Zenith Rewards and external social media), suggested publication calendar, collaboration ideas, SEO/hashtag optimization, and results measurement. Think like a growth hacker.")
-                ai_strategy_plan = strategy_response.text.strip()
-
-            content_id_row = _execute_pg_query(
-                """
-                INSERT INTO ai_contents (user_id, contest_id, prompt, content_type, generated_url, generated_text, ai_strategy_plan, is_published, votes, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-                """,
-                (req.user_id, req.contest_id, req.prompt, req.content_type.value, generated_url, generated_text, ai_strategy_plan, False, 0, datetime.now(timezone.utc)),
-                fetch_one=True, error_context="insert AI content"
-            )
-            ai_content_id = content_id_row['id'] if content_id_row else None
-            
-            if not ai_content_id:
-                logger.error("Failed to retrieve ID of generated AI content after insertion.")
-                raise Exception("Failed to retrieve ID of generated AI content.")
-
-            if req.payment_method == 'points':
-                _execute_pg_query(
-                    "SELECT deduct_points(%s, %s, %s) AS result", # Call SQL function
-                    (req.user_id, cost['points'], f'AI Generation - {req.content_type.value}'),
-                    error_context="deduct points for AI generation"
-                )
-            
-            _execute_pg_query(
-                "UPDATE users SET daily_ai_generations_used = daily_ai_generations_used + 1, last_content_generated_id = %s WHERE user_id = %s",
-                (ai_content_id, req.user_id), error_context="increment AI generations usage"
-            )
-            logger.info(f"AI content generated and usage incremented for user {req.user_id}. Content ID: {ai_content_id}")
-            return {
-                "id": ai_content_id,
-                "prompt": req.prompt,
-                "content_type": req.content_type.value,
-                "generated_url": generated_url,
-                "generated_text": generated_text,
-                "ai_strategy_plan": ai_strategy_plan,
-                "payment_required": False
-            }
-
-        except Exception as e:
-            logger.error(f"Error during AI content generation for user {req.user_id}: {e}", exc_info=True)
-            raise HTTPException(status_code=500, detail=f"Errore durante la generazione AI: {e}. Riprova più tardi.")
+        ai_strategy_plan = DEFAULT_STRATEGY_PLAN
+
+        logger.info(f"Generating AI content ({req.content_type.value}) for user {req.user_id} with prompt: {req.prompt[:50]}...")
+        content_model = gemini_flash_model
+        if req.content_type == ContentType.IMAGE:
+            if not gemini_pro_vision_model:
+                 raise HTTPException(status_code=503, detail="AI image generation model not available.")
+            content_model = gemini_pro_vision_model
+        prompt_values = {"prompt": req.prompt, "content_type": req.content_type.value}
+        content_prompt = CONTENT_PROMPT_TEMPLATES[req.content_type].format_map(prompt_values)
+
+        strategy_template = STRATEGY_PROMPT_TEMPLATES.get(user_plan)
+        strategy_prompt = strategy_template.format_map(prompt_values) if strategy_template else None
+
+        # The content and the virality plan don't depend on each other, so both completions run concurrently.
+        completions = [_generate_text(content_model, content_prompt)]
+        if strategy_prompt:
+            completions.append(_generate_text(gemini_flash_model, strategy_prompt))
+        responses = await asyncio.gather(*completions)
+
+        content_text = responses[0]
+        if req.content_type == ContentType.IMAGE:
+            generated_text = f"Immagine generata: {content_text}\n(Simulazione: L'API reale genererebbe un URL immagine.)"
+            generated_url = "https://via.placeholder.com/400x300?text=AI+Image"
+        elif req.content_type == ContentType.POST:
+            generated_text = content_text
+        elif req.content_type == ContentType.VIDEO:
+            generated_text = f"Sceneggiatura video generata: {content_text}\n(Simulazione: L'API reale genererebbe un URL video.)"
+            generated_url = "https://www.w3schools.com/html/mov_bbb.mp4"
+
+        if strategy_prompt:
+            ai_strategy_plan = responses[1]
+
+        # Insert, points charge and usage bump commit or roll back together.
+        content_id_row = await _execute_pg_query_async(
+            "SELECT create_ai_content(%s, %s, %s, %s, %s, %s, %s, %s, %s) AS id",
+            (req.user_id, req.contest_id, req.prompt, req.content_type.value, generated_url, generated_text, ai_strategy_plan,
+             cost['points'] if req.payment_method == 'points' else None, f'AI Generation - {req.content_type.value}'),
+            fetch_one=True, error_context="store AI content"
+        )
+        _invalidate_user_cache(req.user_id)
+        ai_content_id = content_id_row['id'] if content_id_row else None
+        
+        if not ai_content_id:
+            logger.error("Failed to retrieve ID of generated AI content after insertion.")
+            raise Exception("Failed to retrieve ID of generated AI content.")
+
+        logger.info(f"AI content generated and usage incremented for user {req.user_id}. Content ID: {ai_content_id}")
+        return {
+            "id": ai_content_id,
+            "prompt": req.prompt,
+            "content_type": req.content_type.value,
+            "generated_url": generated_url,
+            "generated_text": generated_text,
+            "ai_strategy_plan": ai_strategy_plan,
+            "payment_required": False
+        }
 
     def publish_ai_content(self, ai_content_id: int):
         logger.info(f"Publishing AI content: {ai_content_id}")
@@ -521,107 +1021,102 @@ class AIManager:
             "UPDATE ai_contents SET is_published = TRUE WHERE id = %s",
             (ai_content_id,), error_context="publish AI content"
         )
+        _invalidate_feed_cache() # New content should show up without waiting for the TTL.
         logger.info(f"AI content {ai_content_id} published successfully.")
         return {"status": "success", "message": "Content published successfully."}
 
-    async def get_feed(self):
+    async def get_feed_json(self) -> bytes:
+        """Returns the feed already serialized, so cache hits skip JSON encoding entirely."""
+        with _read_cache_lock:
+            cached_feed = _feed_cache.get("feed")
+        if cached_feed is not None:
+            return cached_feed
+        async with _feed_refill_lock:
+            # Another request may have refilled the cache while this one waited for the lock.
+            with _read_cache_lock:
+                cached_feed = _feed_cache.get("feed")
+            if cached_feed is None:
+                cached_feed = await self._fetch_feed()
+                with _read_cache_lock:
+                    _feed_cache["feed"] = cached_feed
+        return cached_feed
+
+    async def _fetch_feed(self) -> bytes:
         logger.info("Fetching AI content feed.")
-        response = _execute_pg_query(
+        # Postgres shapes and serializes the whole response (nested "user" included), so the
+        # JSON text goes straight into the cache without building Python objects per row.
+        response = await _execute_pg_query_async(
             """
-            SELECT
-                ac.id, ac.user_id, ac.contest_id, ac.prompt, ac.content_type, ac.generated_url, ac.generated_text, ac.ai_strategy_plan, ac.votes, ac.created_at,
-                u.display_name, u.avatar_url
-            FROM ai_contents ac
-            JOIN users u ON ac.user_id = u.user_id
-            WHERE ac.is_published = TRUE
-            ORDER BY ac.votes DESC, ac.created_at DESC
-            LIMIT 50
+            SELECT COALESCE(jsonb_agg(jsonb_build_object(
+                'id', f.id, 'user_id', f.user_id, 'contest_id', f.contest_id, 'prompt', f.prompt,
+                'content_type', f.content_type, 'generated_url', f.generated_url, 'generated_text', f.generated_text,
+                'ai_strategy_plan', f.ai_strategy_plan, 'votes', f.votes,
+                'user', jsonb_build_object('display_name', f.display_name, 'avatar_url', f.avatar_url)
+            ) ORDER BY f.votes DESC, f.created_at DESC), '[]'::jsonb)::text AS feed
+            FROM (
+                SELECT ac.id, ac.user_id, ac.contest_id, ac.prompt, ac.content_type, ac.generated_url, ac.generated_text,
+                       ac.ai_strategy_plan, ac.votes, ac.created_at, u.display_name, u.avatar_url
+                FROM ai_contents ac
+                JOIN users u ON ac.user_id = u.user_id
+                WHERE ac.is_published = TRUE
+                ORDER BY ac.votes DESC, ac.created_at DESC
+                LIMIT 50
+            ) f
             """,
-            fetch_all=True, error_context="fetch AI content feed"
+            fetch_one=True, error_context="fetch AI content feed"
         )
-        
-        formatted_feed = []
-        if response:
-            for item in response:
-                formatted_feed.append({
-                    "id": item['id'],
-                    "user_id": item['user_id'],
-                    "contest_id": item['contest_id'],
-                    "prompt": item['prompt'],
-                    "content_type": item['content_type'],
-                    "generated_url": item['generated_url'],
-                    "generated_text": item['generated_text'],
-                    "ai_strategy_plan": item['ai_strategy_plan'],
-                    "votes": item['votes'],
-                    "user": {
-                        "display_name": item['display_name'],
-                        "avatar_url": item['avatar_url']
-                    }
-                })
-        logger.info(f"Fetched {len(formatted_feed)} items for AI content feed.")
-        return formatted_feed
+        feed_json = response['feed'].encode() if response else b"[]"
+        logger.info(f"Fetched AI content feed ({len(feed_json)} bytes).")
+        return feed_json
 
     async def vote_content(self, content_id: int, user_id: str):
         logger.info(f"User {user_id} attempting to vote for content {content_id}.")
-        user_manager = UserManager()
-        user_profile = user_manager.get_user_profile(user_id)
-        user_plan = SubscriptionPlan(user_profile.get('subscription_plan', SubscriptionPlan.FREE.value))
-        daily_votes_used = user_profile.get('daily_votes_used', 0)
-        last_vote_reset_dt = datetime.fromisoformat(user_profile.get('last_vote_reset_date', datetime.now(timezone.utc).isoformat()))
-
-        if datetime.now(timezone.utc).date() > last_vote_reset_dt.date():
-            daily_votes_used = 0
-            _execute_pg_query(
-                "UPDATE users SET daily_votes_used = %s, last_vote_reset_date = %s WHERE user_id = %s",
-                (0, datetime.now(timezone.utc), user_id), error_context="reset daily votes"
-            )
-
-        if daily_votes_used >= self.DAILY_VOTE_LIMITS.get(user_plan, 0):
-            logger.warning(f"User {user_id} exceeded daily vote limit for plan {user_plan.value}.")
-            raise HTTPException(status_code=429, detail=f"Hai raggiunto il limite giornaliero di voti ({self.DAILY_VOTE_LIMITS.get(user_plan, 0)}) per il tuo piano '{user_plan.value}'.")
-
-        existing_vote = _execute_pg_query(
-            "SELECT id FROM votes WHERE user_id = %s AND content_id = %s",
-            (user_id, content_id), fetch_one=True, error_context="check existing vote"
+        # cast_vote checks the daily limit, self-votes and duplicates, records the vote and bumps
+        # both counters in one transaction (see migrations/002_cast_vote.sql).
+        result_data = await _execute_pg_query_async(
+            "SELECT cast_vote(%s, %s, %s) AS result",
+            (user_id, content_id, Json(dict(self.DAILY_VOTE_LIMITS_BY_VALUE))), fetch_one=True, error_context="cast vote RPC"
         )
-        if existing_vote:
+        # The content owner's points change too, but their row is only refreshed on expiry.
+        _invalidate_user_cache(user_id)
+        result = result_data['result'] if result_data else None
+        status = result.get('status') if result else None
+
+        if status == 'user_not_found':
+            logger.warning(f"User {user_id} not found while voting for content {content_id}.")
+            raise HTTPException(status_code=404, detail="User not found.")
+        if status == 'limit_reached':
+            logger.warning(f"User {user_id} exceeded daily vote limit for plan {result['plan']}.")
+            raise HTTPException(status_code=429, detail=f"Hai raggiunto il limite giornaliero di voti ({result['limit']}) per il tuo piano '{result['plan']}'.")
+        if status == 'already_voted':
             logger.warning(f"User {user_id} already voted for content {content_id}.")
             raise HTTPException(status_code=400, detail="Hai già votato questo contenuto.")
-
-        content_owner_res = _execute_pg_query(
-            "SELECT user_id FROM ai_contents WHERE id = %s",
-            (content_id,), fetch_one=True, error_context="get content owner"
-        )
-        if content_owner_res and content_owner_res['user_id'] == user_id:
+        if status == 'own_content':
             logger.warning(f"User {user_id} tried to vote for their own content {content_id}.")
             raise HTTPException(status_code=400, detail="Non puoi votare il tuo stesso contenuto.")
+        if status == 'content_not_found':
+            logger.warning(f"User {user_id} tried to vote for missing content {content_id}.")
+            raise HTTPException(status_code=404, detail="Contenuto non trovato.")
+        if status != 'ok':
+            logger.error(f"Unexpected RPC return for cast_vote for user {user_id}, content {content_id}: {result_data}")
+            raise HTTPException(status_code=400, detail="Failed to register vote. Check database function logs for details.")
 
-        _execute_pg_query(
-            "INSERT INTO votes (user_id, content_id, voted_at) VALUES (%s, %s, %s)",
-            (user_id, content_id, datetime.now(timezone.utc)), error_context="insert new vote"
-        )
-        _execute_pg_query(
-            "SELECT increment_content_votes(%s) AS result",
-            (content_id,), error_context="increment content votes RPC"
-        )
-
-        _execute_pg_query(
-            "UPDATE users SET daily_votes_used = %s WHERE user_id = %s",
-            (daily_votes_used + 1, user_id), error_context="increment daily votes usage"
-        )
         logger.info(f"User {user_id} successfully voted for content {content_id}.")
         return {"status": "success", "message": "Voto registrato con successo!"}
 
 class ContestManager:
     def __init__(self): pass
 
-    CONTEST_REWARD_POOLS = {
+    CONTEST_REWARD_POOLS = MappingProxyType({
         SubscriptionPlan.FREE: 10.00,
         SubscriptionPlan.PREMIUM: 30.00,
         SubscriptionPlan.ASSISTANT: 60.00
-    }
+    })
+
+    async def get_current_contest(self, user_plan: SubscriptionPlan):
+        return await _cached_read(_contest_cache, user_plan, lambda: self._fetch_current_contest(user_plan))
 
-    def get_current_contest(self, user_plan: SubscriptionPlan):
+    def _fetch_current_contest(self, user_plan: SubscriptionPlan):
         logger.info(f"Fetching current contest for plan: {user_plan.value}")
         now = datetime.now(timezone.utc)
         result = _execute_pg_query(
@@ -636,6 +1131,7 @@ class ContestManager:
         )
         
         if result:
+            result = dict(result)
             result['reward_pool_euro'] = self.CONTEST_REWARD_POOLS.get(user_plan, 0.00)
             # Convert datetime objects to ISO format strings for JSON serialization
             result['start_date'] = result['start_date'].isoformat() if result['start_date'] else None
@@ -646,19 +1142,38 @@ class ContestManager:
         logger.info(f"No active contest found for plan {user_plan.value}.")
         return None
 
-    def get_leaderboard(self):
+    async def get_leaderboard(self):
+        return await _cached_read(_leaderboard_cache, "top100", self._fetch_leaderboard)
+
+    def _fetch_leaderboard(self):
         logger.info("Fetching leaderboard.")
         response_data = _execute_pg_query(
             "SELECT display_name, avatar_url, points_balance FROM users ORDER BY points_balance DESC LIMIT 100",
             fetch_all=True, error_context="fetch leaderboard"
         )
         logger.info(f"Fetched {len(response_data) if response_data else 0} users for leaderboard.")
-        return response_data if response_data else []
+        return [dict(row) for row in response_data] if response_data else []
+
+async def _refresh_leaderboard_periodically():
+    """Keeps the leaderboard cache warm, so requests don't wait on (or pile up behind) the sort query."""
+    contest_manager = _contest_manager()
+    while True:
+        try:
+            leaderboard = await asyncio.to_thread(contest_manager._fetch_leaderboard)
+            with _read_cache_lock:
+                _leaderboard_cache["top100"] = leaderboard
+        except Exception as e:
+            logger.warning(f"Leaderboard refresh failed: {e}")
+        await asyncio.sleep(LEADERBOARD_REFRESH_INTERVAL)
 
 class ShopManager:
-    def __init__(self): pass
+    def __init__(self, user_manager: UserManager):
+        self.user_manager = user_manager
 
-    def get_shop_items(self):
+    async def get_shop_items(self):
+        return await _cached_read(_shop_items_cache, "all", self._fetch_shop_items)
+
+    def _fetch_shop_items(self):
         logger.info("Fetching shop items.")
         response_data = _execute_pg_query(
             "SELECT id, name, description, price_points, price_eur, item_type, effect, image_url, is_active, created_at FROM shop_items ORDER BY price_points ASC",
@@ -667,47 +1182,55 @@ class ShopManager:
         logger.info(f"Fetched {len(response_data) if response_data else 0} shop items.")
         
         # Convert datetime objects and ensure JSON is properly loaded/formatted
-        if response_data:
-            for item in response_data:
-                if 'effect' in item and item['effect'] is not None and not isinstance(item['effect'], dict):
-                    # psycopg2 DictCursor should handle JSONB directly, but add safeguard
-                    item['effect'] = json.loads(item['effect'])
-                if 'created_at' in item and item['created_at'] is not None:
-                    item['created_at'] = item['created_at'].isoformat()
-        
-        return response_data if response_data else []
+        items = [dict(row) for row in response_data] if response_data else []
+        for item in items:
+            if item['effect'] is not None and not isinstance(item['effect'], dict):
+                # psycopg2 DictCursor should handle JSONB directly, but add safeguard
+                item['effect'] = orjson.loads(item['effect'])
+            if item['created_at'] is not None:
+                item['created_at'] = item['created_at'].isoformat()
+
+        return items
 
     async def buy_item(self, req: ShopBuyRequest):
         logger.info(f"User {req.user_id} attempting to buy item {req.item_id} with {req.payment_method}.")
-        user_manager = UserManager()
-        user_profile = user_manager.get_user_profile(req.user_id)
-        
-        item = _execute_pg_query(
-            "SELECT id, name, description, price_points, price_eur, item_type, effect, image_url, is_active FROM shop_items WHERE id = %s",
-            (req.item_id,), fetch_one=True, error_context=f"fetch shop item {req.item_id}"
-        )
-        
-        if not item: 
-            logger.warning(f"Item {req.item_id} not found for purchase by user {req.user_id}.")
-            raise HTTPException(status_code=404, detail="Item not found.")
 
         if req.payment_method == 'points':
-            if user_profile['points_balance'] < item['price_points']:
-                logger.warning(f"User {req.user_id} has insufficient points ({user_profile['points_balance']}) to buy item {req.item_id} (needed {item['price_points']}).")
-                raise HTTPException(status_code=402, detail="Punti insufficienti per l'acquisto.")
-            
-            _execute_pg_query(
-                "SELECT deduct_points(%s, %s, %s) AS result", # Call SQL function
-                (req.user_id, item['price_points'], f'Shop Purchase: {item["name"]} (Points)'),
-                fetch_one=True, error_context="deduct points for shop item"
+            # Item lookup, balance check, charge, item effect and purchase row in one transaction
+            # (see migrations/009_buy_item_with_points.sql).
+            result_data = await _execute_pg_query_async(
+                "SELECT buy_item_with_points(%s, %s) AS result",
+                (req.user_id, req.item_id), fetch_one=True, error_context="buy item with points RPC"
             )
+            result = result_data['result'] if result_data else None
+            status = result.get('status') if result else None
+
+            if status == 'item_not_found':
+                logger.warning(f"Item {req.item_id} not found for purchase by user {req.user_id}.")
+                raise HTTPException(status_code=404, detail="Item not found.")
+            if status == 'insufficient_points':
+                logger.warning(f"User {req.user_id} has insufficient points ({result['balance']}) to buy item {req.item_id} (needed {result['price']}).")
+                raise HTTPException(status_code=402, detail="Punti insufficienti per l'acquisto.")
+            if status != 'ok':
+                logger.error(f"Unexpected RPC return for buy_item_with_points for user {req.user_id}, item {req.item_id}: {result_data}")
+                raise HTTPException(status_code=400, detail="Failed to complete purchase. Check database function logs for details.")
 
-            await self._apply_item_effect(req.user_id, item, req.payment_method, item['price_points'], None)
+            item = result['item']
+            _invalidate_user_cache(req.user_id)
+            self._log_item_effect(req.user_id, item, result.get('generations', 0))
 
             logger.info(f"User {req.user_id} successfully bought item {item['name']} with points.")
             return {"status": "success", "message": f"Acquisto di '{item['name']}' completato con successo con i punti!"}
-        
-        elif req.payment_method == 'stripe':
+
+        item = await _execute_pg_query_async(
+            "SELECT id, name, price_eur, item_type, effect FROM shop_items WHERE id = %s",
+            (req.item_id,), fetch_one=True, error_context=f"fetch shop item {req.item_id}"
+        )
+        if not item: 
+            logger.warning(f"Item {req.item_id} not found for purchase by user {req.user_id}.")
+            raise HTTPException(status_code=404, detail="Item not found.")
+
+        if req.payment_method == 'stripe':
             if not STRIPE_SECRET_KEY: 
                 logger.error("Stripe not configured for shop purchases.")
                 raise HTTPException(status_code=500, detail="Stripe not configured.")
@@ -715,89 +1238,114 @@ class ShopManager:
                 logger.warning(f"Item {req.item_id} does not have EUR price defined for Stripe purchase.")
                 raise HTTPException(status_code=400, detail="Questo articolo non ha un prezzo in EUR definito.")
 
-            try:
-                payment_intent = stripe.PaymentIntent.create(
-                    amount=int(item['price_eur'] * 100),
-                    currency='eur',
-                    metadata={'user_id': req.user_id, 'item_id': item['id'], 'item_name': item['name']},
-                    automatic_payment_methods={'enabled': True}
-                )
-                logger.info(f"Stripe Payment Intent created for user {req.user_id}, item {item['name']}.")
-                return {"payment_required": True, "client_secret": payment_intent.client_secret, "message": "Procedi al pagamento Stripe."}
+            # Only the client can tell a retry from a deliberate repeat purchase, so it has to send one
+            # key per purchase attempt and reuse it on retries; any server-side fallback gets one of the two wrong.
+            if not req.idempotency_key:
+                logger.warning(f"Stripe purchase of item {req.item_id} by user {req.user_id} sent without an idempotency key.")
+                raise HTTPException(status_code=400, detail="idempotency_key è obbligatorio per gli acquisti con Stripe.")
+            idempotency_key = hashlib.sha256(f"{req.user_id}:{item['id']}:{req.idempotency_key}".encode()).hexdigest()
+
+            metadata = {'user_id': req.user_id, 'item_id': item['id'], 'item_name': item['name']}
+            # Carry what _apply_item_effect needs so the webhook doesn't have to re-read the item.
+            # Stripe metadata values are strings of at most 500 characters; larger effects fall back to the lookup.
+            item_effect = orjson.dumps(self._item_effect(item)).decode()
+            if len(item_effect) <= 500:
+                metadata.update({'item_type': item['item_type'], 'item_effect': item_effect})
+
+            payment_intent = await stripe.PaymentIntent.create_async(
+                amount=int(item['price_eur'] * 100),
+                currency='eur',
+                metadata=metadata,
+                automatic_payment_methods={'enabled': True},
+                idempotency_key=idempotency_key
+            )
+            logger.info(f"Stripe Payment Intent created for user {req.user_id}, item {item['name']}.")
+            return {"payment_required": True, "client_secret": payment_intent.client_secret, "message": "Procedi al pagamento Stripe."}
 
-            except stripe.error.StripeError as e:
-                logger.error(f"Stripe error during Payment Intent creation: {e.user_message}", exc_info=True)
-                raise HTTPException(status_code=500, detail=f"Errore Stripe: {e.user_message}")
-            except Exception as e:
-                logger.error(f"Unexpected error creating Payment Intent: {e}", exc_info=True)
-                raise HTTPException(status_code=500, detail=f"Errore nella creazione del Payment Intent: {e}")
+    @staticmethod
+    def _item_effect(item) -> dict:
+        effect = item.get('effect')
+        if effect is None:
+            return {}
+        return effect if isinstance(effect, dict) else orjson.loads(effect)
 
-    async def _apply_item_effect(self, user_id: str, item: dict, payment_method: str, amount_points: float | None, amount_eur: float | None):
-        logger.info(f"Applying effect for item {item['name']} to user {user_id}. Type: {item['item_type']}")
-        
+    def _log_item_effect(self, user_id: str, item: dict, generations_added: int):
         if item['item_type'] == ItemType.BOOST.value:
-            effect_data = item.get('effect', {})
+            effect_data = self._item_effect(item)
             multiplier = effect_data.get('multiplier', 1.0)
             duration_hours = effect_data.get('duration_hours', 0)
             logger.info(f"Boost '{item['name']}' ({multiplier}x for {duration_hours}h) applied to user {user_id}. Actual effect implementation needed!")
         
         elif item['item_type'] == ItemType.COSMETIC.value:
             logger.info(f"Cosmetic '{item['name']}' applied to user {user_id}. Effect: {item.get('effect')}")
-        
-        elif item['item_type'] == ItemType.GENERATION_PACK.value:
-            effect_data = item.get('effect', {})
-            generations_to_add = effect_data.get('generations', 0)
-            if generations_to_add > 0:
-                user_res = _execute_pg_query(
-                    "SELECT daily_ai_generations_used FROM users WHERE user_id = %s",
-                    (user_id,), fetch_one=True, error_context="fetch user daily generations for item effect"
-                )
-                if user_res:
-                    current_generations_used = user_res['daily_ai_generations_used']
-                    _execute_pg_query(
-                        "UPDATE users SET daily_ai_generations_used = %s WHERE user_id = %s",
-                        (current_generations_used - generations_to_add, user_id), error_context="update user daily generations with item effect"
-                    )
-                    logger.info(f"Added {generations_to_add} AI generations to user {user_id}.")
 
-        _execute_pg_query(
-            """
-            INSERT INTO user_purchases (user_id, item_id, purchase_date, payment_method, amount_paid_points, amount_paid_eur, status, created_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """,
-            (user_id, item['id'], datetime.now(timezone.utc), payment_method, amount_points, amount_eur, 'completed', datetime.now(timezone.utc)),
-            error_context="log user purchase"
-        )
+        if generations_added:
+            logger.info(f"Added {generations_added} AI generations to user {user_id}.")
         logger.info(f"Item effect for {item['name']} applied and purchase logged for user {user_id}.")
 
-def get_user_manager(): return UserManager()
-def get_ai_manager(): return AIManager()
-def get_contest_manager(): return ContestManager()
-def get_shop_manager(): return ShopManager()
+    async def _apply_item_effect(self, user_id: str, item: dict, payment_method: str, amount_points: float | None, amount_eur: float | None):
+        """Applies a paid item and logs the purchase; used for Stripe payments (points purchases do this in buy_item_with_points)."""
+        logger.info(f"Applying effect for item {item['name']} to user {user_id}. Type: {item['item_type']}")
+        generations_to_add = 0
+        if item['item_type'] == ItemType.GENERATION_PACK.value:
+            generations_to_add = max(int(self._item_effect(item).get('generations', 0)), 0)
+
+        # The generation credit and the purchase row are written together (see migrations/010_record_item_purchase.sql).
+        await _execute_pg_query_async(
+            "SELECT record_item_purchase(%s, %s, %s, %s, %s, %s)",
+            (user_id, item['id'], payment_method, amount_points, amount_eur, generations_to_add),
+            error_context="log user purchase"
+        )
+        _invalidate_user_cache(user_id)
+        self._log_item_effect(user_id, item, generations_to_add)
+
+# Managers keep no per-request state, so each one is built once and shared by every request.
+# The getters are async so FastAPI resolves them on the event loop instead of the threadpool.
+@lru_cache(maxsize=1)
+def _user_manager() -> UserManager: return UserManager()
+@lru_cache(maxsize=1)
+def _ai_manager() -> AIManager: return AIManager(_user_manager())
+@lru_cache(maxsize=1)
+def _contest_manager() -> ContestManager: return ContestManager()
+@lru_cache(maxsize=1)
+def _shop_manager() -> ShopManager: return ShopManager(_user_manager())
+
+async def get_user_manager() -> UserManager: return _user_manager()
+async def get_ai_manager() -> AIManager: return _ai_manager()
+async def get_contest_manager() -> ContestManager: return _contest_manager()
+async def get_shop_manager() -> ShopManager: return _shop_manager()
+
+def _json_default(value):
+    # NUMERIC columns come back as Decimal; render them the way FastAPI's encoder does (int when integral).
+    if isinstance(value, Decimal):
+        return decimal_encoder(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def _cacheable_json(request: Request, body: bytes, max_age: int) -> Response:
+    """Serves a public JSON body with an ETag, answering 304 when the client's copy is still current."""
+    etag = f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    headers = {"Cache-Control": f"public, max-age={max_age}", "ETag": etag}
+    if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/")
 def read_root():
     return {"message": "Zenith Rewards Backend is operational. Access the API documentation at /docs."}
 
+@app.get("/healthz")
+async def healthz():
+    # Round-trips through the shared pool, so probes also keep its connections warm.
+    await _execute_pg_query_async("SELECT 1", fetch_one=True, error_context="health check")
+    return {"status": "ok", "vertex_ai": vertexai_initialized}
+
 @app.post("/sync_user")
 def sync_user_endpoint(user_data: UserSyncRequest, user_manager: UserManager = Depends(get_user_manager)):
-    try:
-        return user_manager.sync_user(user_data)
-    except HTTPException as e:
-        logger.error(f"HTTPException in sync_user_endpoint: {e.detail}", exc_info=True)
-        raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in sync_user_endpoint for user {user_data.user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error during user sync: {str(e)}")
+    return user_manager.sync_user(user_data)
 
 @app.post("/update_profile/{user_id}")
 def update_profile_endpoint(user_id: str, profile_data: UserProfileUpdate, user_manager: UserManager = Depends(get_user_manager)):
-    try:
-        return user_manager.update_profile(user_id, profile_data)
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in update_profile_endpoint for user {user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return user_manager.update_profile(user_id, profile_data)
 
 @app.post("/request_payout")
 def request_payout_endpoint(payout_data: PayoutRequest, user_manager: UserManager = Depends(get_user_manager)):
@@ -809,6 +1357,7 @@ def request_payout_endpoint(payout_data: PayoutRequest, user_manager: UserManage
             (payout_data.user_id, payout_data.points_amount, payout_data.points_amount / POINTS_TO_EUR_RATE, payout_data.method, payout_data.address),
             fetch_one=True, error_context="request payout RPC"
         )
+        _invalidate_user_cache(payout_data.user_id)
         
         if result and result['result']:
             logger.info(f"Payout request successful for user {payout_data.user_id}.")
@@ -822,195 +1371,115 @@ def request_payout_endpoint(payout_data: PayoutRequest, user_manager: UserManage
             raise HTTPException(status_code=402, detail="Punti insufficienti per il prelievo.")
         logger.error(f"HTTPException in request_payout_endpoint: {e.detail}", exc_info=True)
         raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in request_payout_endpoint for user {payout_data.user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error processing payout request: {str(e)}")
 
 @app.get("/users/{user_id}/profile")
 def get_user_profile_endpoint(user_id: str, user_manager: UserManager = Depends(get_user_manager)):
-    try:
-        return user_manager.get_user_profile(user_id)
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in get_user_profile_endpoint for user {user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return user_manager.get_user_profile(user_id)
 
 @app.get("/get_user_balance/{user_id}")
 def get_user_balance_endpoint(user_id: str, user_manager: UserManager = Depends(get_user_manager)):
-    try:
-        return user_manager.get_user_balance(user_id)
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in get_user_balance_endpoint for user {user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return user_manager.get_user_balance(user_id)
 
 @app.get("/streak/status/{user_id}")
 def get_streak_status_endpoint(user_id: str, user_manager: UserManager = Depends(get_user_manager)):
-    try:
-        return user_manager.get_streak_status(user_id)
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in get_streak_status_endpoint for user {user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return user_manager.get_streak_status(user_id)
 
 @app.post("/streak/claim/{user_id}")
 def claim_streak_reward_endpoint(user_id: str, user_manager: UserManager = Depends(get_user_manager)):
-    try:
-        return user_manager.claim_streak_reward(user_id)
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in claim_streak_reward_endpoint for user {user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return user_manager.claim_streak_reward(user_id)
 
 @app.get("/leaderboard")
-def get_leaderboard_endpoint(contest_manager: ContestManager = Depends(get_contest_manager)):
-    try:
-        return contest_manager.get_leaderboard()
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in get_leaderboard_endpoint: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+async def get_leaderboard_endpoint(request: Request, contest_manager: ContestManager = Depends(get_contest_manager)):
+    # Public and user-independent: browsers and CDNs may reuse it for as long as the server-side cache does.
+    return _cacheable_json(request, orjson.dumps(await contest_manager.get_leaderboard(), default=_json_default), LEADERBOARD_CACHE_TTL)
 
 @app.get("/referral_stats/{user_id}")
 def get_referral_stats_endpoint(user_id: str, user_manager: UserManager = Depends(get_user_manager)):
-    try:
-        return user_manager.get_referral_stats(user_id)
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in get_referral_stats_endpoint for user {user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return user_manager.get_referral_stats(user_id)
 
 @app.post("/ai/generate-advice")
 async def generate_advice_endpoint(req: AIAdviceRequest, ai_manager: AIManager = Depends(get_ai_manager)):
-    try:
-        return await ai_manager.generate_advice(req)
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in generate_advice_endpoint for user {req.user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return await ai_manager.generate_advice(req)
+
+@app.post("/ai/generate-advice/stream")
+async def stream_advice_endpoint(req: AIAdviceRequest, ai_manager: AIManager = Depends(get_ai_manager)):
+    return StreamingResponse(
+        await ai_manager.stream_advice(req),
+        media_type="text/event-stream",
+        # Keeps proxies from buffering the stream until it ends.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.post("/ai/generate")
 async def generate_content_endpoint(req: AIGenerationRequest, ai_manager: AIManager = Depends(get_ai_manager)):
-    try:
-        return await ai_manager.generate_content(req)
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in generate_content_endpoint for user {req.user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return await ai_manager.generate_content(req)
 
 @app.post("/ai/content/{ai_content_id}/publish")
 def publish_content_endpoint(ai_content_id: int, ai_manager: AIManager = Depends(get_ai_manager)):
-    try:
-        return ai_manager.publish_ai_content(ai_content_id)
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in publish_content_endpoint for content {ai_content_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return ai_manager.publish_ai_content(ai_content_id)
 
 @app.get("/ai/content/feed")
-async def get_content_feed_endpoint(ai_manager: AIManager = Depends(get_ai_manager)):
-    try:
-        return await ai_manager.get_feed()
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in get_content_feed_endpoint: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+async def get_content_feed_endpoint(request: Request, ai_manager: AIManager = Depends(get_ai_manager)):
+    # Lets bursts of home-screen loads be absorbed by the HTTP cache.
+    return _cacheable_json(request, await ai_manager.get_feed_json(), FEED_CACHE_TTL)
 
 @app.post("/ai/content/{content_id}/vote")
 async def vote_content_endpoint(content_id: int, req: VoteContentRequest, ai_manager: AIManager = Depends(get_ai_manager)):
-    try:
-        return await ai_manager.vote_content(content_id, req.user_id)
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in vote_content_endpoint for content {content_id} by user {req.user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return await ai_manager.vote_content(content_id, req.user_id)
 
 @app.get("/contests/current/{user_id}")
-def get_current_contest_endpoint(user_id: str, contest_manager: ContestManager = Depends(get_contest_manager)):
-    try:
-        user_manager = UserManager() # Instance created here
-        user_profile = user_manager.get_user_profile(user_id)
-        user_plan = SubscriptionPlan(user_profile.get('subscription_plan', SubscriptionPlan.FREE.value))
-        contest = contest_manager.get_current_contest(user_plan)
-        if not contest:
-            raise HTTPException(status_code=404, detail="Nessun contest attivo disponibile per il tuo piano al momento.")
-        return contest
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in get_current_contest_endpoint for user {user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+async def get_current_contest_endpoint(user_id: str, contest_manager: ContestManager = Depends(get_contest_manager), user_manager: UserManager = Depends(get_user_manager)):
+    # The contest itself comes from the per-plan cache, so the plan is the only per-request read.
+    user_plan = await asyncio.to_thread(user_manager.get_subscription_plan, user_id)
+    contest = await contest_manager.get_current_contest(user_plan)
+    if not contest:
+        raise HTTPException(status_code=404, detail="Nessun contest attivo disponibile per il tuo piano al momento.")
+    return contest
 
 @app.get("/shop/items")
-def get_shop_items_endpoint(shop_manager: ShopManager = Depends(get_shop_manager)):
-    try:
-        return shop_manager.get_shop_items()
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in get_shop_items_endpoint: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+async def get_shop_items_endpoint(request: Request, shop_manager: ShopManager = Depends(get_shop_manager)):
+    return _cacheable_json(request, orjson.dumps(await shop_manager.get_shop_items(), default=_json_default), SHOP_ITEMS_CACHE_TTL)
 
 @app.post("/shop/buy")
 async def buy_shop_item_endpoint(req: ShopBuyRequest, shop_manager: ShopManager = Depends(get_shop_manager)):
-    try:
-        return await shop_manager.buy_item(req)
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in buy_shop_item_endpoint for user {req.user_id}, item {req.item_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return await shop_manager.buy_item(req)
 
 @app.post("/create-checkout-session")
-def create_checkout_session_endpoint(req: CreateSubscriptionRequest):
+async def create_checkout_session_endpoint(req: CreateSubscriptionRequest, user_manager: UserManager = Depends(get_user_manager)):
     if not stripe.api_key: raise HTTPException(status_code=500, detail="Stripe not configured.")
-    price_map = {
-        'premium': STRIPE_PRICE_ID_PREMIUM,
-        'assistant': STRIPE_PRICE_ID_ASSISTANT
-    }
-    price_id = price_map.get(req.plan_type)
+    price_id = PLAN_TO_PRICE.get(req.plan_type)
     if not price_id: raise HTTPException(status_code=400, detail="Invalid plan type specified.")
     
-    try:
-        user_manager = UserManager()
-        user_profile_data = user_manager.get_user_profile(req.user_id) # This call ensures DB access works
-        user_email = user_profile_data.get('email') # Assuming email is retrieved by get_user_profile
-        user_stripe_customer_id = user_profile_data.get('stripe_customer_id')
-
-        customer_id = user_stripe_customer_id
-        
-        if not customer_id:
-            logger.info(f"Creating new Stripe customer for user {req.user_id}.")
-            customer = stripe.Customer.create(
-                email=user_email,
-                metadata={'user_id': req.user_id}
-            )
-            customer_id = customer.id
-            _execute_pg_query(
-                "UPDATE users SET stripe_customer_id = %s WHERE user_id = %s",
-                (customer_id, req.user_id), error_context="update user with Stripe customer ID"
-            )
-        
-        checkout_session = stripe.checkout.Session.create(
-            customer=customer_id,
-            line_items=[{'price': price_id, 'quantity': 1}],
-            mode='subscription',
-            success_url=req.success_url,
-            cancel_url=req.cancel_url,
-            metadata={
-                'user_id': req.user_id,
-                'plan_type': req.plan_type
-            }
+    # Stripe calls are awaited on the shared HTTPX client; only the DB lookups need a worker thread.
+    stripe_customer = await asyncio.to_thread(user_manager.get_stripe_customer, req.user_id)
+    customer_id = stripe_customer['stripe_customer_id']
+
+    if not customer_id:
+        logger.info(f"Creating new Stripe customer for user {req.user_id}.")
+        # The idempotency key makes concurrent checkouts for the same user get the same customer back.
+        customer = await stripe.Customer.create_async(
+            email=stripe_customer['email'],
+            metadata={'user_id': req.user_id},
+            idempotency_key=f"customer-{req.user_id}"
         )
-        logger.info(f"Stripe Checkout Session created for user {req.user_id}.")
-        return {"url": checkout_session.url}
-    except stripe.error.StripeError as e:
-        logger.error(f"Stripe error creating checkout session: {e.user_message}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Errore Stripe: {e.user_message}")
-    except HTTPException as e: raise e
-    except Exception as e:
-        logger.critical(f"Unhandled exception in create_checkout_session_endpoint for user {req.user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+        customer_id = await asyncio.to_thread(user_manager.set_stripe_customer, req.user_id, customer.id)
+    
+    checkout_session = await stripe.checkout.Session.create_async(
+        customer=customer_id,
+        line_items=[{'price': price_id, 'quantity': 1}],
+        mode='subscription',
+        success_url=req.success_url,
+        cancel_url=req.cancel_url,
+        metadata={
+            'user_id': req.user_id,
+            'plan_type': req.plan_type
+        }
+    )
+    logger.info(f"Stripe Checkout Session created for user {req.user_id}.")
+    return {"url": checkout_session.url}
 
 @app.post("/stripe-webhook")
-async def stripe_webhook(request: Request):
+async def stripe_webhook(request: Request, background_tasks: BackgroundTasks, shop_manager: ShopManager = Depends(get_shop_manager)):
     payload = await request.body()
     sig_header = request.headers.get('stripe-signature')
 
@@ -1019,7 +1488,12 @@ async def stripe_webhook(request: Request):
         raise HTTPException(status_code=500, detail="Stripe webhook secret not configured.")
 
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+        # Same checks as stripe.Webhook.construct_event, but the event stays a plain dict parsed
+        # by orjson instead of being rebuilt into nested StripeObjects the handlers don't use.
+        stripe.WebhookSignature.verify_header(
+            payload.decode("utf-8"), sig_header, STRIPE_WEBHOOK_SECRET, stripe.Webhook.DEFAULT_TOLERANCE
+        )
+        event = orjson.loads(payload)
     except ValueError as e:
         logger.error(f"Invalid payload for Stripe webhook: {e}")
         raise HTTPException(status_code=400, detail=f"Invalid payload: {e}")
@@ -1030,76 +1504,147 @@ async def stripe_webhook(request: Request):
         logger.error(f"Unexpected error processing Stripe webhook event: {e}", exc_info=True)
         raise HTTPException(status_code=400, detail=f"Webhook error: {e}")
 
+    logger.info(f"Received Stripe webhook event type: {event['type']}")
+
+    # Stripe delivers events at least once: claim the event id before acknowledging, so the claim is
+    # durable by the time Stripe stops retrying. A redelivery of an event whose processing failed
+    # reclaims it; anything else already claimed is skipped.
+    try:
+        claimed = await _execute_pg_query_async(
+            "INSERT INTO stripe_events (event_id, event_type, received_at, status) VALUES (%s, %s, %s, 'received') "
+            "ON CONFLICT (event_id) DO UPDATE SET status = 'received', error = NULL, received_at = EXCLUDED.received_at, "
+            "attempts = stripe_events.attempts + 1 "
+            "WHERE stripe_events.status = 'failed' RETURNING event_id",
+            (event['id'], event['type'], datetime.now(timezone.utc)),
+            fetch_one=True, error_context="record Stripe event"
+        )
+    except HTTPException:
+        # Without the claim the event could be lost: make Stripe retry it.
+        raise HTTPException(status_code=503, detail="Could not record the event, please retry.")
+    if not claimed:
+        logger.info(f"Stripe event {event['id']} already received, skipping.")
+        return Response(status_code=200)
+
+    # Fulfillment runs after the response is sent; its outcome is recorded on the claim row, and
+    # _retry_stripe_events_periodically re-runs events that fail or never finish.
+    background_tasks.add_task(_process_stripe_event, event, shop_manager)
+    return Response(status_code=200)
+
+async def _process_stripe_event(event, shop_manager: ShopManager):
+    status, error = 'processed', None
+    try:
+        await _handle_stripe_event(event, shop_manager)
+    except Exception as e:
+        logger.error(f"Error processing Stripe event {event['id']} ({event['type']}): {e}", exc_info=True)
+        status, error = 'failed', f"{type(e).__name__}: {e}"
+    await _record_stripe_event_status(event['id'], status, error)
+
+async def _record_stripe_event_status(event_id: str, status: str, error: str | None):
+    try:
+        await _execute_pg_query_async(
+            "UPDATE stripe_events SET status = %s, error = %s, processed_at = %s WHERE event_id = %s",
+            (status, error, datetime.now(timezone.utc), event_id), error_context="update Stripe event status"
+        )
+    except HTTPException:
+        # The row stays 'received', so the retry sweep still picks the event up.
+        logger.error(f"Could not record status '{status}' for Stripe event {event_id}.")
+
+async def _retry_stripe_events_periodically():
+    """Re-runs webhook events that failed or never finished; Stripe won't resend them after our 200."""
+    while True:
+        await asyncio.sleep(STRIPE_EVENT_RETRY_INTERVAL)
+        try:
+            await _retry_unprocessed_stripe_events()
+        except Exception as e:
+            logger.warning(f"Stripe event retry sweep failed: {e}")
+
+async def _retry_unprocessed_stripe_events():
+    # Claiming moves received_at forward, which keeps other workers (and the next sweep) off these events.
+    claimed = await _execute_pg_query_async(
+        """
+        UPDATE stripe_events SET status = 'received', error = NULL, received_at = now(), attempts = attempts + 1
+        WHERE event_id IN (
+            SELECT event_id FROM stripe_events
+            WHERE status <> 'processed' AND received_at < now() - make_interval(secs => %s) AND attempts < %s
+            ORDER BY received_at
+            LIMIT 20
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING event_id, attempts
+        """,
+        (STRIPE_EVENT_RETRY_AFTER, STRIPE_EVENT_MAX_ATTEMPTS), fetch_all=True, error_context="claim unprocessed Stripe events"
+    )
+    for row in claimed or []:
+        event_id = row['event_id']
+        try:
+            # The raw body is the same JSON a webhook delivery carries, so the handlers see the same dicts.
+            event = orjson.loads((await stripe.Event.retrieve_async(event_id)).last_response.body)
+        except stripe.error.StripeError as e:
+            logger.error(f"Could not fetch Stripe event {event_id} for retry: {e}")
+            await _record_stripe_event_status(event_id, 'failed', f"{type(e).__name__}: {e}")
+            continue
+        logger.info(f"Retrying Stripe event {event_id} ({event['type']}), attempt {row['attempts']}.")
+        await _process_stripe_event(event, _shop_manager())
+
+async def _handle_stripe_event(event, shop_manager: ShopManager):
     event_type = event['type']
     data_object = event['data']['object']
-    logger.info(f"Received Stripe webhook event type: {event_type}")
-
-    # Use direct _execute_pg_query or UserManager/ShopManager methods that wrap it
-    user_manager = UserManager() 
-    shop_manager = ShopManager()
 
     if event_type == 'customer.subscription.created' or event_type == 'customer.subscription.updated':
         subscription = data_object
         customer_id = subscription.get('customer')
         price_id = subscription['items']['data'][0]['price']['id']
         status = subscription.get('status')
-        
-        user_res = _execute_pg_query(
-            "SELECT user_id FROM users WHERE stripe_customer_id = %s",
-            (customer_id,), fetch_one=True, error_context="fetch user for subscription webhook"
+
+        new_plan = SubscriptionPlan.FREE.value
+        if status in ['active', 'trialing']:
+            new_plan = PRICE_TO_PLAN.get(price_id, SubscriptionPlan.FREE.value)
+
+        # Update by customer id directly: one round trip instead of a user lookup followed by an update.
+        # Most updates (renewals, payment method changes) keep the plan; those match no row and write nothing.
+        user_res = await _execute_pg_query_async(
+            "UPDATE users SET subscription_plan = %s WHERE stripe_customer_id = %s AND subscription_plan IS DISTINCT FROM %s RETURNING user_id",
+            (new_plan, customer_id, new_plan), fetch_one=True, error_context="update user subscription plan"
         )
-        
         if user_res:
-            user_id = user_res['user_id']
-            new_plan = SubscriptionPlan.FREE.value
-            
-            if price_id == STRIPE_PRICE_ID_PREMIUM:
-                new_plan = SubscriptionPlan.PREMIUM.value
-            elif price_id == STRIPE_PRICE_ID_ASSISTANT:
-                new_plan = SubscriptionPlan.ASSISTANT.value
-            
-            if status in ['active', 'trialing']:
-                _execute_pg_query(
-                    "UPDATE users SET subscription_plan = %s WHERE user_id = %s",
-                    (new_plan, user_id), error_context="update user subscription plan"
-                )
-                logger.info(f"User {user_id} subscription plan updated to {new_plan} (status: {status}).")
-            else:
-                _execute_pg_query(
-                    "UPDATE users SET subscription_plan = %s WHERE user_id = %s",
-                    (SubscriptionPlan.FREE.value, user_id), error_context="revert user subscription plan"
-                )
-                logger.info(f"User {user_id} subscription plan reverted to FREE (status: {status}).")
+            _invalidate_user_cache(user_res['user_id'])
+            logger.info(f"User {user_res['user_id']} subscription plan set to {new_plan} (status: {status}).")
         else:
-            logger.warning(f"User not found for Stripe customer ID: {customer_id} during subscription webhook.")
+            logger.info(f"No plan change for Stripe customer ID {customer_id} (already {new_plan}, or no matching user).")
 
     elif event_type == 'customer.subscription.deleted':
         customer_id = data_object.get('customer')
-        user_res = _execute_pg_query(
-            "SELECT user_id FROM users WHERE stripe_customer_id = %s",
-            (customer_id,), fetch_one=True, error_context="fetch user for deleted subscription webhook"
+        user_res = await _execute_pg_query_async(
+            "UPDATE users SET subscription_plan = %s WHERE stripe_customer_id = %s AND subscription_plan IS DISTINCT FROM %s RETURNING user_id",
+            (SubscriptionPlan.FREE.value, customer_id, SubscriptionPlan.FREE.value), fetch_one=True, error_context="revert user plan on subscription delete"
         )
         if user_res:
-            _execute_pg_query(
-                "UPDATE users SET subscription_plan = %s WHERE user_id = %s",
-                (SubscriptionPlan.FREE.value, user_res['user_id']), error_context="revert user plan on subscription delete"
-            )
+            _invalidate_user_cache(user_res['user_id'])
             logger.info(f"User {user_res['user_id']} subscription deleted, reverted to FREE plan.")
         else:
-            logger.warning(f"User not found for Stripe customer ID: {customer_id} during deleted subscription webhook.")
-            
+            logger.info(f"No plan change for Stripe customer ID {customer_id} on subscription delete (already FREE, or no matching user).")
+
     elif event_type == 'payment_intent.succeeded':
         payment_intent = data_object
-        user_id = payment_intent['metadata'].get('user_id')
-        item_id = payment_intent['metadata'].get('item_id')
+        metadata = payment_intent['metadata']
+        user_id = metadata.get('user_id')
+        item_id = metadata.get('item_id')
         
         if user_id and item_id:
-            item = _execute_pg_query(
-                "SELECT id, name, description, price_points, price_eur, item_type, effect, image_url, is_active FROM shop_items WHERE id = %s",
-                (int(item_id),), fetch_one=True, error_context="fetch item for payment intent succeeded"
-            )
+            if 'item_type' in metadata:
+                item = {
+                    'id': int(item_id), 'name': metadata.get('item_name'),
+                    'item_type': metadata['item_type'], 'effect': orjson.loads(metadata['item_effect']),
+                }
+            else:
+                # Payment intents created before the item fields were added to metadata.
+                item = await _execute_pg_query_async(
+                    "SELECT id, name, item_type, effect FROM shop_items WHERE id = %s",
+                    (int(item_id),), fetch_one=True, error_context="fetch item for payment intent succeeded"
+                )
             if item:
-                await shop_manager._apply_item_effect(user_id, item, 'stripe', None, item.get('price_eur'))
+                amount_eur = payment_intent.get('amount_received', payment_intent.get('amount', 0)) / 100
+                await shop_manager._apply_item_effect(user_id, item, 'stripe', None, amount_eur)
                 logger.info(f"Payment intent succeeded for user {user_id}, item {item['name']}. Effect applied.")
             else:
                 logger.warning(f"Item {item_id} not found for successful payment intent for user {user_id}.")
@@ -1108,6 +1653,4 @@ async def stripe_webhook(request: Request):
 
     else:
         logger.info(f"Unhandled Stripe event type: {event_type}")
-
-    return Response(status_code=200)
 # Questo è un commento per forzare un nuovo deployment
\ No newline at end of file
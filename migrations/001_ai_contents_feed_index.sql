@@ -0,0 +1,4 @@
+-- Serves the feed query (published contents ordered by votes, then recency) from an index range scan.
+CREATE INDEX IF NOT EXISTS ai_contents_feed_idx
+    ON ai_contents (votes DESC, created_at DESC)
+    WHERE is_published = TRUE;
@@ -0,0 +1,65 @@
+-- One vote per user per content, enforced by the database.
+DELETE FROM votes a USING votes b
+    WHERE a.user_id = b.user_id AND a.content_id = b.content_id AND a.id > b.id;
+CREATE UNIQUE INDEX IF NOT EXISTS votes_user_content_uidx ON votes (user_id, content_id);
+
+-- Validates and records a vote in a single transaction.
+-- p_vote_limits maps subscription plan -> daily vote limit, e.g. {"free": 5, "premium": 20}.
+-- Returns {"status": "ok" | "user_not_found" | "limit_reached" | "already_voted" | "own_content" | "content_not_found", ...}.
+CREATE OR REPLACE FUNCTION cast_vote(p_user_id text, p_content_id bigint, p_vote_limits jsonb)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_plan text := 'free';
+    v_votes_used integer := 0;
+    v_reset_date timestamptz;
+    v_needs_reset boolean := FALSE;
+    v_limit integer;
+    v_owner text;
+BEGIN
+    SELECT COALESCE(subscription_plan, 'free'), COALESCE(daily_votes_used, 0), last_vote_reset_date
+      INTO v_plan, v_votes_used, v_reset_date
+      FROM users
+     WHERE user_id = p_user_id
+       FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('status', 'user_not_found');
+    END IF;
+
+    -- Days are UTC days, like the advice quota and sync_user's resets, whatever the session time zone is.
+    IF (v_reset_date AT TIME ZONE 'UTC')::date < (now() AT TIME ZONE 'UTC')::date THEN
+        v_votes_used := 0;
+        v_needs_reset := TRUE;
+    END IF;
+
+    v_limit := COALESCE((p_vote_limits ->> v_plan)::integer, 0);
+    IF v_votes_used >= v_limit THEN
+        RETURN jsonb_build_object('status', 'limit_reached', 'plan', v_plan, 'limit', v_limit);
+    END IF;
+
+    SELECT user_id INTO v_owner FROM ai_contents WHERE id = p_content_id;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('status', 'content_not_found');
+    END IF;
+    IF v_owner = p_user_id THEN
+        RETURN jsonb_build_object('status', 'own_content');
+    END IF;
+
+    INSERT INTO votes (user_id, content_id, voted_at)
+    VALUES (p_user_id, p_content_id, now())
+    ON CONFLICT (user_id, content_id) DO NOTHING;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('status', 'already_voted');
+    END IF;
+
+    PERFORM increment_content_votes(p_content_id);
+
+    UPDATE users
+       SET daily_votes_used = v_votes_used + 1,
+           last_vote_reset_date = CASE WHEN v_needs_reset THEN now() ELSE last_vote_reset_date END
+     WHERE user_id = p_user_id;
+
+    RETURN jsonb_build_object('status', 'ok');
+END;
+$$;
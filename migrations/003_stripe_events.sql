@@ -0,0 +1,6 @@
+-- Records processed Stripe webhook events so redeliveries of the same event are skipped.
+CREATE TABLE IF NOT EXISTS stripe_events (
+    event_id text PRIMARY KEY,
+    event_type text NOT NULL,
+    received_at timestamptz NOT NULL DEFAULT now()
+);
@@ -0,0 +1,4 @@
+-- Lets the referral count for a user run as an index-only scan.
+CREATE INDEX IF NOT EXISTS users_referrer_idx
+    ON users (referrer_id)
+    WHERE referrer_id IS NOT NULL;
@@ -0,0 +1,4 @@
+-- Serves the top-100 leaderboard from an index-only scan.
+CREATE INDEX IF NOT EXISTS users_points_desc_idx
+    ON users (points_balance DESC)
+    INCLUDE (display_name, avatar_url);
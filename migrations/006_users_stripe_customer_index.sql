@@ -0,0 +1,5 @@
+-- Webhook subscription updates look users up by Stripe customer id; each customer belongs to exactly one user.
+-- CONCURRENTLY avoids blocking writes to users while the index builds, so keep this file to this single statement.
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_stripe_customer_uidx
+    ON users (stripe_customer_id)
+    WHERE stripe_customer_id IS NOT NULL;
@@ -0,0 +1,35 @@
+-- Stores a generated AI content, charges its points cost (NULL = nothing to charge) and bumps
+-- the user's daily generation usage in a single transaction. Returns the new content id.
+CREATE OR REPLACE FUNCTION create_ai_content(
+    p_user_id text,
+    p_contest_id bigint,
+    p_prompt text,
+    p_content_type text,
+    p_generated_url text,
+    p_generated_text text,
+    p_ai_strategy_plan text,
+    p_points_cost integer,
+    p_charge_reason text
+)
+RETURNS bigint
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_content_id bigint;
+BEGIN
+    INSERT INTO ai_contents (user_id, contest_id, prompt, content_type, generated_url, generated_text, ai_strategy_plan, is_published, votes, created_at)
+    VALUES (p_user_id, p_contest_id, p_prompt, p_content_type, p_generated_url, p_generated_text, p_ai_strategy_plan, FALSE, 0, now())
+    RETURNING id INTO v_content_id;
+
+    IF p_points_cost IS NOT NULL THEN
+        PERFORM deduct_points(p_user_id, p_points_cost, p_charge_reason);
+    END IF;
+
+    UPDATE users
+       SET daily_ai_generations_used = daily_ai_generations_used + 1,
+           last_content_generated_id = v_content_id
+     WHERE user_id = p_user_id;
+
+    RETURN v_content_id;
+END;
+$$;
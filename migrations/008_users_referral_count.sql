@@ -0,0 +1,35 @@
+-- Referral stats read a counter kept on the referrer's row instead of counting users on every request.
+-- One transaction: ADD COLUMN holds an exclusive lock on users until COMMIT, so no referred user can be
+-- inserted between installing the trigger and the backfill, and the backfill sets absolute counts.
+BEGIN;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_count integer NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION users_bump_referral_count()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' AND NEW.referrer_id IS NOT NULL THEN
+        UPDATE users SET referral_count = referral_count + 1 WHERE user_id = NEW.referrer_id;
+    ELSIF TG_OP = 'DELETE' AND OLD.referrer_id IS NOT NULL THEN
+        UPDATE users SET referral_count = GREATEST(referral_count - 1, 0) WHERE user_id = OLD.referrer_id;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- referrer_id is only set when the user row is created (sync_user never updates it).
+DROP TRIGGER IF EXISTS users_referral_count_trg ON users;
+CREATE TRIGGER users_referral_count_trg
+    AFTER INSERT OR DELETE ON users
+    FOR EACH ROW
+    EXECUTE FUNCTION users_bump_referral_count();
+
+UPDATE users u
+   SET referral_count = r.referral_count
+  FROM (SELECT referrer_id, COUNT(*) AS referral_count FROM users WHERE referrer_id IS NOT NULL GROUP BY referrer_id) r
+ WHERE u.user_id = r.referrer_id
+   AND u.referral_count IS DISTINCT FROM r.referral_count;
+
+COMMIT;
@@ -0,0 +1,55 @@
+-- Completes a points purchase in one transaction: balance check, charge, generation-pack credit and the
+-- purchase row all commit or roll back together. The user row is locked so two concurrent purchases
+-- can't both pass the balance check. (Stripe purchases are recorded by record_item_purchase, migration 010.)
+-- Returns {"status": "ok", "item": {...}, "generations": n} or {"status": "item_not_found" | "insufficient_points", ...}.
+CREATE OR REPLACE FUNCTION buy_item_with_points(p_user_id text, p_item_id bigint)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_item shop_items%ROWTYPE;
+    v_balance numeric := 0;
+    v_generations integer := 0;
+BEGIN
+    SELECT * INTO v_item FROM shop_items WHERE id = p_item_id;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('status', 'item_not_found');
+    END IF;
+
+    SELECT COALESCE(points_balance, 0) INTO v_balance
+      FROM users
+     WHERE user_id = p_user_id
+       FOR UPDATE;
+
+    IF COALESCE(v_balance, 0) < v_item.price_points THEN
+        RETURN jsonb_build_object('status', 'insufficient_points', 'balance', COALESCE(v_balance, 0), 'price', v_item.price_points);
+    END IF;
+
+    PERFORM deduct_points(p_user_id, v_item.price_points, 'Shop Purchase: ' || v_item.name || ' (Points)');
+
+    -- Credits are subtracted from the day's usage counter, so it can go negative to carry them past the plan limit.
+    IF v_item.item_type = 'GENERATION_PACK' THEN
+        v_generations := GREATEST(COALESCE(trunc((v_item.effect::jsonb ->> 'generations')::numeric)::integer, 0), 0);
+        IF v_generations > 0 THEN
+            UPDATE users
+               SET daily_ai_generations_used = COALESCE(daily_ai_generations_used, 0) - v_generations
+             WHERE user_id = p_user_id;
+        END IF;
+    END IF;
+
+    INSERT INTO user_purchases (user_id, item_id, purchase_date, payment_method, amount_paid_points, amount_paid_eur, status, created_at)
+    VALUES (p_user_id, v_item.id, now(), 'points', v_item.price_points, NULL, 'completed', now());
+
+    RETURN jsonb_build_object(
+        'status', 'ok',
+        'item', jsonb_build_object(
+            'id', v_item.id,
+            'name', v_item.name,
+            'price_points', v_item.price_points,
+            'item_type', v_item.item_type,
+            'effect', v_item.effect
+        ),
+        'generations', v_generations
+    );
+END;
+$$;
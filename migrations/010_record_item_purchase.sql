@@ -0,0 +1,25 @@
+-- Logs a Stripe shop purchase and credits a generation pack's extra AI generations in one transaction
+-- (points purchases do the same inside buy_item_with_points, migration 009).
+-- Credits are subtracted from the day's usage counter, so it can go negative to carry them past the plan limit.
+CREATE OR REPLACE FUNCTION record_item_purchase(
+    p_user_id text,
+    p_item_id bigint,
+    p_payment_method text,
+    p_amount_points numeric,
+    p_amount_eur numeric,
+    p_generations integer
+)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF p_generations > 0 THEN
+        UPDATE users
+           SET daily_ai_generations_used = COALESCE(daily_ai_generations_used, 0) - p_generations
+         WHERE user_id = p_user_id;
+    END IF;
+
+    INSERT INTO user_purchases (user_id, item_id, purchase_date, payment_method, amount_paid_points, amount_paid_eur, status, created_at)
+    VALUES (p_user_id, p_item_id, now(), p_payment_method, p_amount_points, p_amount_eur, 'completed', now());
+END;
+$$;
@@ -0,0 +1,4 @@
+-- The current-contest lookup walks contests in end_date order and stops at the first running one
+-- the plan can access, so ended contests are skipped by the index instead of scanned and sorted.
+CREATE INDEX IF NOT EXISTS contests_end_date_idx
+    ON contests (end_date, start_date);
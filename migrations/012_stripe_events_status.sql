@@ -0,0 +1,13 @@
+-- Webhook events are claimed before Stripe gets its 200 and then processed in the background, so a
+-- claim alone no longer means the event was handled. status is 'received' until processing finishes,
+-- then 'processed' or 'failed' (with the error). Rows that already exist were fully processed.
+ALTER TABLE stripe_events
+    ADD COLUMN IF NOT EXISTS status text NOT NULL DEFAULT 'processed',
+    ADD COLUMN IF NOT EXISTS error text,
+    ADD COLUMN IF NOT EXISTS processed_at timestamptz;
+ALTER TABLE stripe_events ALTER COLUMN status SET DEFAULT 'received';
+
+-- Events still needing attention (failed, or never finished because the worker went away).
+CREATE INDEX IF NOT EXISTS stripe_events_unprocessed_idx
+    ON stripe_events (received_at)
+    WHERE status <> 'processed';
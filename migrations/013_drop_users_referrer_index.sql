@@ -0,0 +1,4 @@
+-- users_referrer_idx (004) served the per-request COUNT(*) of referred users; referral stats now read
+-- users.referral_count (008), and the trigger looks referrers up by primary key, so nothing uses it.
+-- CONCURRENTLY avoids blocking writes to users while the index is dropped, so keep this file to this single statement.
+DROP INDEX CONCURRENTLY IF EXISTS users_referrer_idx;
@@ -0,0 +1,4 @@
+-- Stripe does not redeliver an event it already got a 200 for, so the app re-runs failed or stuck events
+-- itself (fetched again with Event.retrieve). attempts caps those retries; received_at is the time of the
+-- latest claim, which keeps other workers off an event while it is being processed.
+ALTER TABLE stripe_events ADD COLUMN IF NOT EXISTS attempts integer NOT NULL DEFAULT 1;